@@ -0,0 +1,360 @@
+import numpy as np
+import os
+import sys
+import json
+import shutil
+import timeit
+import resource
+import platform
+import multiprocessing
+from datetime import datetime, timedelta
+
+'''----------------------------------------
+|   Class: Benchmark                       |
+|   Generates synthetic fire sequences and |
+|   times each stage of the program on     |
+|   them, so runs can be compared without  |
+|   real aerial images.                    |
+|------------------------------------------|
+'''
+
+STAGES = ('compress', 'kmeans', 'connected_components', 'contours')
+
+
+###################################################
+##       Function: generate_sequence             ##
+## Writes num_frames georeferenced uint16        ##
+## GeoTIFFs of a fire: a blob with a ragged edge ##
+## that grows every frame, on top of sensor      ##
+## noise, with black borders that change size    ##
+## and an origin that drifts as if the camera    ##
+## moved. Names carry a timestamp like the real  ##
+## images. The same seed gives the same frames.  ##
+###################################################
+def generate_sequence(directory, num_frames=20, width=1024, height=768, bands=4, seed=0):
+   import rasterio as rst
+   import affine
+   if not os.path.exists(directory):
+      os.makedirs(directory)
+   rng = np.random.default_rng(seed)
+   rows, cols = np.mgrid[:height, :width]
+   center_row = height * 0.55
+   center_col = width * 0.45
+   angles = np.arctan2(rows - center_row, cols - center_col)
+   distances = np.hypot(rows - center_row, cols - center_col)
+   # a few random harmonics make the edge of the fire ragged
+   harmonics = [(int(rng.integers(2, 9)), rng.uniform(0, 2 * np.pi), rng.uniform(0.03, 0.1)) for _ in range(4)]
+   ragged = 1 + sum(amplitude * np.sin(order * angles + phase) for order, phase, amplitude in harmonics)
+   start = datetime(2020, 8, 1, 18, 0, 0)
+   paths = []
+   for frame in range(num_frames):
+      radius = min(height, width) * (0.05 + 0.3 * frame / max(num_frames - 1, 1))
+      fire = distances < radius * ragged
+      data = np.empty((bands, height, width), dtype=np.uint16)
+      for band in range(bands):
+         noise = rng.normal(1500, 400, (height, width)).clip(0, 65535)
+         noise[fire] += rng.normal(9000, 1500, int(fire.sum())).clip(0, None)
+         data[band] = noise.clip(0, 65535).astype(np.uint16)
+      border = int(rng.integers(height // 40, height // 12))
+      data[:, :border] = 0
+      data[:, -border // 2:] = 0
+      data[:, :, :int(rng.integers(width // 50, width // 15))] = 0
+
+      transform = affine.Affine(0.0001, 0, -111.0 + frame * 0.00002, 0, -0.0001, 34.0 - frame * 0.00001)
+      name = "SYN_" + (start + timedelta(seconds=30 * frame)).strftime("%Y%m%dT%H%M%SZ") + ".tif"
+      path = directory + "/" + name
+      with rst.open(path, 'w', driver='GTiff', width=width, height=height, count=bands, dtype='uint16', crs='EPSG:4326', transform=transform) as raster:
+         raster.write(data)
+      paths.append(path)
+   return paths
+
+
+###################################################
+##       Function: directory_size                ##
+## Total size in bytes of the files under path.  ##
+###################################################
+def directory_size(path):
+   total = 0
+   for root, directories, files in os.walk(path):
+      for file_name in files:
+         total += os.path.getsize(os.path.join(root, file_name))
+   return total
+
+
+###################################################
+##       Function: peak_rss_mb                   ##
+## Peak resident memory in MB of this process    ##
+## and, separately, of its finished children.    ##
+## ru_maxrss is in KB on Linux and bytes on Mac. ##
+###################################################
+def peak_rss_mb():
+   scale = 1024.0 * 1024.0 if platform.system() == "Darwin" else 1024.0
+   own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+   children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+   return own, children
+
+
+###################################################
+##       Function: run_stage                     ##
+## Runs one stage of the program on work_dir,    ##
+## the way Main.runPrograms does, and returns    ##
+## its wall time. Stage modules are imported     ##
+## here so import time is not counted.           ##
+###################################################
+def run_stage(stage, work_dir, num_components, num_workers):
+   from CompressImage import CompressImage
+   from KMeansConverter import KMeansConverter
+   from ConnectedComp import ConnectedComp
+   from Contour2Shp import Contour2Shp
+   from Main import Program
+   tic = timeit.default_timer()
+   if stage == 'compress':
+      ci = CompressImage()
+      ci.get_roi_width_height(work_dir + "/input", 4, work_dir + "/extent_index.json")
+      ci.compress_images(ci.image_locations(work_dir + "/input"), work_dir + "/CompressedImages", num_workers, 4)
+   elif stage == 'kmeans':
+      km = KMeansConverter()
+      for image_path in km.image_locations(work_dir + "/CompressedImages"):
+         km.apply_KMeans(image_path, work_dir + "/KMeans")
+      km.save_manifest()
+   elif stage == 'connected_components':
+      ConnectedComp().apply_connected_comp(work_dir + "/KMeans", work_dir + "/Connected Components/cc6_" + str(num_components), num_components, None)
+   elif stage == 'contours':
+      Contour2Shp().convert_npy_2_shp(work_dir + "/Connected Components", work_dir + "/Shape Files", num_workers=num_workers)
+   elif stage == 'end_to_end':
+      Program().runPrograms(work_dir + "/input", work_dir + "/end_to_end", str(num_components), True, num_workers)
+   return timeit.default_timer() - tic
+
+
+###################################################
+##       Function: measure_stage                 ##
+## Runs run_stage in its own process, so its     ##
+## peak memory is not mixed up with earlier      ##
+## stages, and sends back its wall time, peak    ##
+## RSS (main process and workers) and the bytes  ##
+## it added to work_dir. Worker pools inside the ##
+## stage use start_method, the parent's default, ##
+## rather than the spawn used for this process.  ##
+###################################################
+def measure_stage(stage, work_dir, num_components, num_workers, queue, start_method):
+   multiprocessing.set_start_method(start_method, force=True)
+   before = directory_size(work_dir)
+   try:
+      seconds = run_stage(stage, work_dir, num_components, num_workers)
+      own, children = peak_rss_mb()
+      queue.put({
+         'wall_seconds': seconds,
+         'peak_rss_mb': own,
+         'peak_worker_rss_mb': children,
+         'bytes_written': directory_size(work_dir) - before
+      })
+   except Exception as error:
+      queue.put({'error': repr(error)})
+
+
+class Benchmark:
+   ###################################################
+   ##       Function: run                           ##
+   ## Generates a sequence in work_dir/input and    ##
+   ## measures each stage, then the whole program   ##
+   ## end to end. work_dir is emptied first so no   ##
+   ## manifest lets a stage skip work. Returns the  ##
+   ## results, and saves them as JSON to            ##
+   ## save_path if given.                           ##
+   ###################################################
+   def run(self, work_dir, num_frames=20, width=1024, height=768, num_workers=1, num_components=5, save_path=None, seed=0):
+      if os.path.exists(work_dir):
+         shutil.rmtree(work_dir)
+      os.makedirs(work_dir)
+      print("Generating {} frames of {}x{}...".format(num_frames, width, height))
+      generate_sequence(work_dir + "/input", num_frames, width, height, seed=seed)
+      results = {
+         'config': {'num_frames': num_frames, 'width': width, 'height': height, 'num_workers': num_workers, 'num_components': num_components, 'seed': seed},
+         'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+         'date': datetime.now().isoformat(timespec='seconds'),
+         'input_bytes': directory_size(work_dir + "/input"),
+         'stages': {}
+      }
+      for stage in STAGES + ('end_to_end',):
+         print("Benchmarking " + stage + "...")
+         results['stages'][stage] = self.measure(stage, work_dir, num_components, num_workers)
+         print("\t" + json.dumps(results['stages'][stage]))
+      results['stages_total_seconds'] = sum(results['stages'][stage].get('wall_seconds', 0) for stage in STAGES)
+      if save_path is not None:
+         self.save(results, save_path)
+      return results
+
+   ###################################################
+   ##       Function: measure                       ##
+   ## Measures one stage in a fresh process (see    ##
+   ## measure_stage).                               ##
+   ###################################################
+   def measure(self, stage, work_dir, num_components, num_workers):
+      context = multiprocessing.get_context("spawn")
+      queue = context.Queue()
+      process = context.Process(target=measure_stage, args=(stage, work_dir, num_components, num_workers, queue, multiprocessing.get_start_method()))
+      process.start()
+      result = queue.get()
+      process.join()
+      return result
+
+   ###################################################
+   ##       Function: profiles                      ##
+   ## Times writing the compressed and k-means      ##
+   ## images of a synthetic sequence with each      ##
+   ## OutputProfile, with GDAL compressing on       ##
+   ## num_threads threads, and reading them back.   ##
+   ## Throughput is in MB of raw pixels per second, ##
+   ## and the ratio is raw bytes over bytes on      ##
+   ## disk. Returns the results, and saves them as  ##
+   ## JSON to save_path if given.                   ##
+   ###################################################
+   def profiles(self, work_dir, num_frames=20, width=1024, height=768, num_threads=None, save_path=None, seed=0):
+      import rasterio as rst
+      from CompressImage import scale_band
+      from KMeansConverter import KMeansConverter
+      from OutputProfile import PROFILES, write_raster
+      if os.path.exists(work_dir):
+         shutil.rmtree(work_dir)
+      os.makedirs(work_dir)
+      print("Generating {} frames of {}x{}...".format(num_frames, width, height))
+      paths = generate_sequence(work_dir + "/input", num_frames, width, height, seed=seed)
+      km = KMeansConverter("histogram")
+      images = {'compressed': [], 'kmeans': []}
+      for path in paths:
+         with rst.open(path) as raster:
+            band = scale_band(raster.read(4))
+            profile = raster.profile
+         images['compressed'].append((os.path.basename(path), band, profile))
+         images['kmeans'].append((os.path.basename(path), km.cluster_band(band), profile))
+
+      results = {
+         'config': {'num_frames': num_frames, 'width': width, 'height': height, 'num_threads': num_threads, 'seed': seed},
+         'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+         'date': datetime.now().isoformat(timespec='seconds'),
+         'profiles': {}
+      }
+      print("{:10s}{:12s}{:>12s}{:>12s}{:>12s}{:>12s}{:>10s}".format("profile", "images", "write s", "write MB/s", "read s", "MB on disk", "ratio"))
+      for output in PROFILES:
+         results['profiles'][output] = {}
+         for kind, frames in images.items():
+            directory = work_dir + "/" + output + "/" + kind
+            os.makedirs(directory)
+            raw_bytes = sum(band.nbytes for name, band, profile in frames)
+            tic = timeit.default_timer()
+            for name, band, profile in frames:
+               write_raster(directory + "/" + name, band, profile, output, num_threads, categorical=(kind == "kmeans"))
+            write_seconds = timeit.default_timer() - tic
+            tic = timeit.default_timer()
+            for name, band, profile in frames:
+               with rst.open(directory + "/" + name) as raster:
+                  raster.read(1)
+            read_seconds = timeit.default_timer() - tic
+            disk_bytes = directory_size(directory)
+            measured = {
+               'write_seconds': write_seconds,
+               'write_mb_per_s': raw_bytes / 1e6 / write_seconds,
+               'read_seconds': read_seconds,
+               'bytes': disk_bytes,
+               'compression_ratio': raw_bytes / float(disk_bytes)
+            }
+            results['profiles'][output][kind] = measured
+            print("{:10s}{:12s}{:>12.3f}{:>12.1f}{:>12.3f}{:>12.2f}{:>10.1f}".format(output, kind, write_seconds, measured['write_mb_per_s'], read_seconds, disk_bytes / 1e6, measured['compression_ratio']))
+      if save_path is not None:
+         self.save(results, save_path)
+      return results
+
+   ###################################################
+   ##       Function: chunkcheck                    ##
+   ## Generates a sequence, compresses it and runs  ##
+   ## k-means on it, then labels it both whole and  ##
+   ## chunk_size frames at a time (see              ##
+   ## ConnectedComp.compare_chunked). A chunk size  ##
+   ## that does not divide num_frames also checks   ##
+   ## a short last chunk. Returns the comparison.   ##
+   ###################################################
+   def chunkcheck(self, work_dir, num_frames=20, width=1024, height=768, chunk_size=6, num_components=5, seed=0):
+      from ConnectedComp import ConnectedComp
+      if os.path.exists(work_dir):
+         shutil.rmtree(work_dir)
+      os.makedirs(work_dir)
+      print("Generating {} frames of {}x{}...".format(num_frames, width, height))
+      generate_sequence(work_dir + "/input", num_frames, width, height, seed=seed)
+      for stage in ('compress', 'kmeans'):
+         run_stage(stage, work_dir, num_components, 1)
+      comparison = ConnectedComp().compare_chunked(work_dir + "/KMeans", work_dir + "/chunkcheck", num_components, chunk_size)
+      print(json.dumps(comparison))
+      if comparison['labels_identical'] and comparison['components_identical'] and comparison['names_identical'] and comparison['meta_identical']:
+         print("Chunked labeling matches labeling every frame at once")
+      else:
+         print("Warning: chunked labeling does not match labeling every frame at once")
+      return comparison
+
+   ###################################################
+   ##       Function: save                          ##
+   ## Writes results as JSON.                       ##
+   ###################################################
+   def save(self, results, save_path):
+      with open(save_path, "w") as results_file:
+         json.dump(results, results_file, indent=1)
+      print("Saved results to " + save_path)
+
+   ###################################################
+   ##       Function: compare                       ##
+   ## Prints each stage's time, memory and bytes    ##
+   ## against a baseline results file and returns   ##
+   ## the stages that got slower or bigger by more  ##
+   ## than tolerance (0.1 is 10%).                  ##
+   ###################################################
+   def compare(self, results, baseline_path, tolerance=0.1):
+      with open(baseline_path, "r") as baseline_file:
+         baseline = json.load(baseline_file)
+      if baseline.get('config') != results.get('config'):
+         print("Warning: the baseline was run with a different configuration: " + json.dumps(baseline.get('config')))
+      regressions = []
+      for stage, measured in results['stages'].items():
+         base = baseline['stages'].get(stage)
+         if base is None or 'error' in measured or 'error' in base:
+            continue
+         for field in ('wall_seconds', 'peak_rss_mb', 'peak_worker_rss_mb', 'bytes_written'):
+            if base.get(field, 0) <= 0:
+               continue
+            ratio = measured[field] / base[field]
+            flag = ""
+            if ratio > 1 + tolerance:
+               flag = "  <-- regression"
+               regressions.append((stage, field, ratio))
+            print("{:22s}{:20s}{:>14.3f}{:>14.3f}{:>8.2f}x{}".format(stage, field, base[field], measured[field], ratio, flag))
+      return regressions
+
+
+def main():
+   bench = Benchmark()
+   if len(sys.argv) >= 3 and sys.argv[1].lower() == "generate":
+      numbers = [int(arg) for arg in sys.argv[3:6]]
+      generate_sequence(sys.argv[2], *numbers)
+   elif len(sys.argv) >= 4 and sys.argv[1].lower() == "run":
+      numbers = [int(arg) for arg in sys.argv[4:8]]
+      results = bench.run(sys.argv[2], *numbers, save_path=sys.argv[3])
+      if len(sys.argv) == 9:
+         bench.compare(results, sys.argv[8])
+   elif len(sys.argv) >= 4 and sys.argv[1].lower() == "profiles":
+      numbers = [int(arg) for arg in sys.argv[4:7]]
+      num_threads = sys.argv[7] if len(sys.argv) == 8 else None
+      bench.profiles(sys.argv[2], *numbers, num_threads=num_threads, save_path=sys.argv[3])
+   elif len(sys.argv) >= 3 and sys.argv[1].lower() == "chunkcheck":
+      numbers = [int(arg) for arg in sys.argv[3:8]]
+      bench.chunkcheck(sys.argv[2], *numbers)
+   elif len(sys.argv) == 4 and sys.argv[1].lower() == "compare":
+      with open(sys.argv[2], "r") as results_file:
+         bench.compare(json.load(results_file), sys.argv[3])
+   else:
+      print("To make a synthetic fire sequence please enter: generate save_directory [frames] [width] [height]")
+      print("To benchmark every stage please enter: run work_directory results.json [frames] [width] [height] [number_workers] [baseline.json]")
+      print("\tThe baseline can only be given after all of the numbers.")
+      print("To compare saved results against a baseline please enter: compare results.json baseline.json")
+      print("To check that labeling in chunks matches labeling every frame at once please enter: chunkcheck work_directory [frames] [width] [height] [chunk_size] [number_components]")
+      print("To time writing images with each output profile please enter: profiles work_directory results.json [frames] [width] [height] [threads or ALL_CPUS]")
+
+if __name__ == "__main__":
+   main()
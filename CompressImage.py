@@ -2,21 +2,304 @@ import numpy as np
 import os
 import sys
 from pathlib import Path
-import rasterio as rst
-from rasterio.crs import CRS
-from rasterio.enums import Resampling
-from rasterio import shutil as rio_shutil
-from rasterio.vrt import WarpedVRT
-
-import rasterio.features
-import rasterio.warp
-import rasterio.transform
-import affine
-import matplotlib.pyplot as plt
-import cv2 as cv
+import json
+from contextlib import contextmanager
+from functools import partial
+import traceback
+from Manifest import Manifest, load_json, save_json
+from OutputProfile import DEFAULT_PROFILE, copy_raster, write_raster
+from Instrumentation import span, file_size
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+###################################################
+##       Function: scale_band                    ##
+## Normalises a band by its maximum value and    ##
+## rescales it to 0-255 as uint8. max_val is the ##
+## maximum of the whole band when only a block   ##
+## of it is given. Unsigned integer bands are    ##
+## scaled with integer arithmetic in one         ##
+## temporary.                                    ##
+###################################################
+def scale_band(band, max_val=None):
+   if max_val is None:
+      max_val = np.max(band)
+   if np.issubdtype(band.dtype, np.unsignedinteger):
+      if max_val == 0:
+         return np.zeros(band.shape, dtype=np.uint8)
+      scaled = band.astype(np.uint64 if band.dtype.itemsize >= 4 else np.uint32)
+      scaled *= 255
+      scaled //= max_val
+      return scaled.astype(np.uint8)
+   band = band / max_val
+   band = band * 255
+   return band.astype(np.uint8)
+
+
+###################################################
+##       Function: band_windows                  ##
+## Windows covering a band, following the        ##
+## file's internal blocks. Blocks that span the  ##
+## whole width (striped files) are grouped into  ##
+## strips of at least min_rows rows so each read ##
+## is not a single row.                          ##
+###################################################
+def band_windows(src, band_num, min_rows=256):
+   block_height, block_width = src.block_shapes[band_num - 1]
+   if block_width < src.width:
+      for _, window in src.block_windows(band_num):
+         yield window
+   else:
+      from rasterio.windows import Window
+      rows = max(1, min_rows // block_height) * block_height
+      for row in range(0, src.height, rows):
+         yield Window(0, row, src.width, min(rows, src.height - row))
+
+
+###################################################
+##       Function: band_statistics               ##
+## Reads a band one block at a time and returns  ##
+## its maximum along with the maximum of every   ##
+## row and every column, so the whole band is    ##
+## never in memory.                              ##
+###################################################
+def band_statistics(src, band_num):
+   dtype = np.dtype(src.dtypes[band_num - 1])
+   lowest = np.iinfo(dtype).min if np.issubdtype(dtype, np.integer) else -np.inf
+   row_max = np.full(src.height, lowest, dtype=dtype)
+   col_max = np.full(src.width, lowest, dtype=dtype)
+   for window in band_windows(src, band_num):
+      block = src.read(band_num, window=window)
+      rows = slice(window.row_off, window.row_off + window.height)
+      cols = slice(window.col_off, window.col_off + window.width)
+      np.maximum(row_max[rows], block.max(axis=1), out=row_max[rows])
+      np.maximum(col_max[cols], block.max(axis=0), out=col_max[cols])
+   return row_max.max(), row_max, col_max
+
+
+###################################################
+##       Function: write_scaled_band             ##
+## Writes scale_band of band band_num of src to  ##
+## the first band of dst block by block.         ##
+###################################################
+def write_scaled_band(src, band_num, dst):
+   max_val = band_statistics(src, band_num)[0]
+   for window in band_windows(src, band_num):
+      dst.write(scale_band(src.read(band_num, window=window), max_val), 1, window=window)
+
+
+###################################################
+##       Function: open_warped                   ##
+## Opens image_path warped onto the shared       ##
+## target grid produced by                       ##
+## CompressImage.target_grid. If band_num is     ##
+## given only that band is used: it is scaled to ##
+## uint8 and warped from an in-memory dataset,   ##
+## so nothing is written to disk.                ##
+###################################################
+@contextmanager
+def open_warped(image_path, grid, band_num=None):
+   import rasterio as rst
+   import affine
+   from rasterio.crs import CRS
+   from rasterio.enums import Resampling
+   from rasterio.vrt import WarpedVRT
+   from rasterio.io import MemoryFile
+   dst_crs = CRS.from_epsg(4326) # Coordinate system Hu Tzu Shan 1950
+   vrt_options = {
+      'resampling': Resampling.cubic,
+      'crs':dst_crs,
+      'transform':affine.Affine(*grid['transform']),
+      'height':grid['height'],
+      'width':grid['width']
+   }
+   with rst.open(image_path) as raster:
+      if band_num is None:
+         with WarpedVRT(raster, **vrt_options) as vrt:
+            yield vrt
+      else:
+         with MemoryFile() as memfile:
+            with memfile.open(**scaled_profile(raster)) as scaled:
+               write_scaled_band(raster, band_num, scaled)
+            with memfile.open() as scaled:
+               with WarpedVRT(scaled, **vrt_options) as vrt:
+                  yield vrt
+
+
+###################################################
+##       Function: warp_to_grid                  ##
+## Warps a single image onto the shared target   ##
+## grid and copies it to save_path with the      ##
+## output profile (see OutputProfile). It is     ##
+## kept at module level so that worker processes ##
+## can run it with their own rasterio dataset.   ##
+###################################################
+def warp_to_grid(image_path, save_path, grid, band_num=None, output=DEFAULT_PROFILE, num_threads=None):
+   with span("warp", frame=os.path.basename(image_path), bytes_read=file_size(image_path)) as fields:
+      with open_warped(image_path, grid, band_num) as vrt:
+         copy_raster(vrt, save_path, output, num_threads)
+      fields['bytes_written'] = file_size(save_path)
+
+
+###################################################
+##       Function: warp_to_array                 ##
+## Warps a single image onto the shared target   ##
+## grid and returns its first band as an array   ##
+## along with a GTiff profile for it.            ##
+###################################################
+def warp_to_array(image_path, grid, band_num=None):
+   with span("warp", frame=os.path.basename(image_path), bytes_read=file_size(image_path)), open_warped(image_path, grid, band_num) as vrt:
+      band = vrt.read(1)
+      profile = {
+         'driver': 'GTiff',
+         'width': vrt.width,
+         'height': vrt.height,
+         'count': 1,
+         'dtype': band.dtype.name,
+         'crs': vrt.crs,
+         'transform': vrt.transform,
+         'nodata': vrt.nodata
+      }
+   return band, profile
+
+
+###################################################
+##       Function: scaled_profile                ##
+## Profile of the single uint8 band that         ##
+## scale_band produces from src. The source      ##
+## nodata value is only kept if it fits uint8.   ##
+###################################################
+def scaled_profile(src):
+   nodata = src.nodata
+   if nodata is not None and not 0 <= nodata <= 255:
+      nodata = None
+   return {
+      'driver': 'GTiff',
+      'width': src.width,
+      'height': src.height,
+      'count': 1,
+      'dtype': 'uint8',
+      'crs': src.crs,
+      'transform': src.transform,
+      'nodata': nodata
+   }
+
+
+###################################################
+##       Function: compress_worker               ##
+## Runs warp_to_grid for one (image_path,        ##
+## save_path, grid, band_num, output,            ##
+## num_threads) task. Failures are               ##
+## returned to the parent instead of raised, and ##
+## any half written output is removed so the     ##
+## image is redone on the next run.              ##
+###################################################
+def compress_worker(task):
+   image_path, save_path, grid, band_num, output, num_threads = task
+   try:
+      warp_to_grid(image_path, save_path, grid, band_num, output, num_threads)
+      return image_path, None
+   except Exception:
+      if os.path.exists(save_path):
+         os.remove(save_path)
+      return image_path, traceback.format_exc()
+
+
+###################################################
+##       Function: compress_array_worker         ##
+## Runs warp_to_array for one (image_path,       ##
+## save_path, grid, band_num, output,            ##
+## num_threads) task, and writes the array to    ##
+## save_path with the output profile unless      ##
+## save_path is None.                            ##
+## Returns (image_path, band, profile, error).   ##
+###################################################
+def compress_array_worker(task):
+   image_path, save_path, grid, band_num, output, num_threads = task
+   try:
+      band, profile = warp_to_array(image_path, grid, band_num)
+      if save_path is not None:
+         with span("write", frame=os.path.basename(save_path), output=output) as fields:
+            write_raster(save_path, band, profile, output, num_threads)
+            fields['bytes_written'] = file_size(save_path)
+      return image_path, band, profile, None
+   except Exception:
+      if save_path is not None and os.path.exists(save_path):
+         os.remove(save_path)
+      return image_path, None, None, traceback.format_exc()
+
+
+###################################################
+##       Function: read_extent                   ##
+## Reads the extent of an image from its header  ##
+## (width, height, transform and bounds) without ##
+## decoding any pixels. Returns None if the file ##
+## cannot be opened.                             ##
+###################################################
+def read_extent(image_path):
+   import rasterio as rst
+   try:
+      with rst.open(image_path) as raster:
+         left, bottom, right, top = raster.bounds
+         return {
+            'left': left,
+            'bottom': bottom,
+            'right': right,
+            'top': top,
+            'width': raster.width,
+            'height': raster.height,
+            'transform': list(raster.transform)[:6]
+         }
+   except Exception:
+      return None
+
+
+# Kept in the extent index for an all black band, so it is not read again
+NO_EXTENT = {'empty': True}
+
+
+###################################################
+##       Function: read_roi_extent               ##
+## Finds the bounding box of the non black       ##
+## pixels of a scaled band, and returns its      ##
+## coordinates along with its width and height   ##
+## in pixels. A row or column has a non black    ##
+## pixel exactly when its maximum does, so only  ##
+## the block-wise maxima of band_statistics are  ##
+## needed. Returns None if the file cannot be    ##
+## opened, and NO_EXTENT if the band is black.   ##
+###################################################
+def read_roi_extent(image_path, band_num=4):
+   import rasterio as rst
+   try:
+      with span("roi_extent", frame=os.path.basename(image_path), bytes_read=file_size(image_path)), rst.open(image_path) as src:
+         max_val, row_max, col_max = band_statistics(src, band_num)
+         if max_val <= 0:
+            return NO_EXTENT
+         rows = np.flatnonzero(scale_band(row_max, max_val))
+         cols = np.flatnonzero(scale_band(col_max, max_val))
+         top = int(rows[0])
+         left = int(cols[0])
+         bottom = int(rows[-1])
+         right = int(cols[-1])
+
+         leftCoord, topCoord = src.xy(top, left, offset='ul')
+         rightCoord, bottomCoord = src.xy(bottom, right, offset='lr')
+         return {
+            'left': leftCoord,
+            'bottom': bottomCoord,
+            'right': rightCoord,
+            'top': topCoord,
+            'width': right - left,
+            'height': bottom - top
+         }
+   except Exception:
+      return None
+
 
 class CompressImage:
    IND = 0
+   manifest = None
    ###################################################
    ##       Function: image_locations               ##
    ## Retrieves file paths from the designated      ##
@@ -51,49 +334,32 @@ class CompressImage:
    ## coordinate, and maximum right and top         ##
    ## coordinate. This function essentially gathers ##
    ## information for a bounding box for images.    ##
+   ## Extents are read from the file headers over a ##
+   ## thread pool and kept in an extent index, so   ##
+   ## only new or changed files are opened again.   ##
+   ## The index defaults to path/extent_index.json. ##
    ###################################################
-   def get_width_height(self, path="Original_Images"):
+   def get_width_height(self, path="Original_Images", index_path=None, num_threads=8):
+      import affine
+      import rasterio.transform
       print('Calculating Max Width and Height Needed')
-      minBottom = 9999999
-      minLeft = 9999999
-      maxTop = 0
-      maxRight = 0
-      max_width = 0
-      max_height = 0
+      if index_path is None:
+         index_path = os.path.join(path, "extent_index.json")
       image_paths = self.image_locations(path)
-      for index, image_path in enumerate(image_paths):
-         try:
-            raster = rst.open(image_path)
-            band = raster.read(1)
-            x, y = band.shape
-            x -= 1
-            y -= 1
-            left, top = raster.xy(0, 0, offset='ul')
-            right, bottom = raster.xy(x, y, offset='lr')
-
-            if index == 0:
-               minBottom = bottom
-               minLeft = left
-               maxTop = top
-               maxRight = right
-
-            else:
-               if bottom < minBottom:
-                  minBottom = bottom
-               if left < minLeft:
-                  minLeft = left
-               if right > maxRight:
-                  maxRight = right
-               if top > maxTop:
-                  maxTop = top
-            raster.close()
-         except:
-            print("Cannot open file: ", image_path)
-      minX, minY = raster.index(minLeft, maxTop)
-      maxX, maxY = raster.index(maxRight, minBottom)
-      width = maxX - minX
-      height = maxY - minY
-      raster.close()
+      extents = self.update_extent_index(image_paths, 'extent', read_extent, index_path, num_threads)
+      if len(extents) == 0:
+         print("No readable images in: ", path)
+         return None
+      minLeft = min(extent['left'] for extent in extents)
+      minBottom = min(extent['bottom'] for extent in extents)
+      maxRight = max(extent['right'] for extent in extents)
+      maxTop = max(extent['top'] for extent in extents)
+
+      # Width and height are measured in pixels of the last image
+      transform = affine.Affine(*extents[-1]['transform'])
+      rows, cols = rasterio.transform.rowcol(transform, [minLeft, maxRight], [maxTop, minBottom])
+      width = int(cols[1] - cols[0])
+      height = int(rows[1] - rows[0])
 
       self.minLeft = minLeft
       self.maxTop = maxTop
@@ -104,12 +370,59 @@ class CompressImage:
 
       return minLeft, maxTop, maxRight, minBottom, width, height
 
+   ###################################################
+   ##       Function: update_extent_index           ##
+   ## Brings one field of the extent index up to    ##
+   ## date for image_paths. The index is a JSON     ##
+   ## file (see Manifest.save_json) keyed by the    ##
+   ## absolute image path, holding the file size,   ##
+   ## modification time and extents. Files whose    ##
+   ## size or modification time changed are read    ##
+   ## again with reader over a thread pool. Returns ##
+   ## the field for every readable image that has   ##
+   ## an extent, in order. Images the reader finds  ##
+   ## no extent in keep NO_EXTENT in the index.     ##
+   ###################################################
+   def update_extent_index(self, image_paths, field, reader, index_path, num_threads=8):
+      index = load_json(index_path, "Could not read the extent index, rebuilding: ")
+
+      to_scan = []
+      for image_path in image_paths:
+         key = os.path.abspath(image_path)
+         stat = os.stat(image_path)
+         entry = index.get(key)
+         if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            index[key] = {'size': stat.st_size, 'mtime': stat.st_mtime}
+            to_scan.append((key, image_path))
+         elif field not in entry:
+            to_scan.append((key, image_path))
+      print("Reading extents of {} of {} images".format(len(to_scan), len(image_paths)))
+
+      with ThreadPoolExecutor(max_workers=num_threads) as executor:
+         extents = executor.map(reader, [image_path for key, image_path in to_scan])
+         for (key, image_path), extent in zip(to_scan, extents):
+            if extent is None:
+               print("Cannot open file: ", image_path)
+               index.pop(key, None)
+            else:
+               index[key][field] = extent
+      save_json(index, index_path)
+
+      extents = []
+      for image_path in image_paths:
+         entry = index.get(os.path.abspath(image_path))
+         if entry is not None and entry[field] != NO_EXTENT:
+            extents.append(entry[field])
+      return extents
+
 
    ###################################################
    ##       Function: region_of_interest            ##
-   ## Removes all of the unneccessary black pixels  ##
-   ## around an image, then modifies the meta data  ##
-   ## to use the new top left corner.               ##
+   ## Finds the region of an image without the      ##
+   ## unneccessary black pixels around it, and adds ##
+   ## it to the bounding box of all regions. No     ##
+   ## intermediate files are written; the scaled    ##
+   ## band is warped in memory by compress_images.  ##
    ###################################################
    minBottom = 9999999
    minLeft = 9999999
@@ -119,158 +432,65 @@ class CompressImage:
    max_height = 0
    index = 0
    def region_of_interest(self, image_path, band_num = 4):
-      dst_crs = rst.crs.CRS.from_epsg(4326)
-      if not os.path.exists("IntRegImgs"):
-         os.makedirs("IntRegImgs")
-      name = self.get_file_name(image_path)
-      if not os.path.exists("IntRegImgs/" + name):
-         try:
-            with rst.open(image_path) as src:
-               # Write bands
-               band = src.read(band_num)
-               meta = src.profile
-               meta['count'] = 1
-               meta['dtype'] ='uint8'
-               max_val = np.max(band)
-               band = band / max_val
-               band = band * 255
-               band = band.astype(np.uint8)
-               if not os.path.exists("Band4"):
-                  os.makedirs("Band4")
-               raster = []
-               if not os.path.exists("Band4/" + name):
-                  raster = rst.open("Band4" + '/' + name, 'w', **meta)
-                  raster.write(band, 1)
-                  no_black_pix = np.where(band != 0)
-                  top = np.amin(no_black_pix[0])
-                  left = np.amin(no_black_pix[1])
-                  bottom = np.amax(no_black_pix[0])
-                  right = np.amax(no_black_pix[1])
-
-                  dst_width = right - left
-                  dst_height = bottom - top
-
-                  leftCoord, topCoord = src.xy(top, left)
-                  rightCoord, bottomCoord = src.xy(bottom, right)
-
-                  if self.index == 0:
-                     self.minBottom = bottomCoord
-                     self.minLeft = leftCoord
-                     self.maxTop = topCoord
-                     self.maxRight = rightCoord
-                     self.max_width = dst_width
-                     self.max_height = dst_height
-                     self.index += 1
-
-                  else:
-                     if bottomCoord < self.minBottom:
-                        self.minBottom = bottomCoord
-                     if leftCoord < self.minLeft:
-                        self.minLeft = leftCoord
-                     if rightCoord > self.maxRight:
-                        self.maxRight = rightCoord
-                     if topCoord > self.maxTop:
-                        self.maxTop = topCoord
-                     if dst_width > self.max_width:
-                        self.max_width = dst_width
-                     if dst_height > self.max_height:
-                        self.max_height = dst_height
-
-
-                  xres = meta['transform'][0]
-                  yres = -meta['transform'][4]
-                  dst_transform = affine.Affine(xres, 0.0, leftCoord, 0.0, -yres, topCoord)
-                  vrt_options = {
-                     'resampling': rst.enums.Resampling.cubic,
-                     'crs':dst_crs,
-                     'transform':dst_transform,
-                     'height':dst_height,
-                     'width':dst_width
-                  }
-                  with WarpedVRT(raster, **vrt_options) as vrt:
-                     rio_shutil.copy(vrt, "IntRegImgs/"+name, driver='GTiff')
-                     raster.close()
-               else:
-                  raster = rst.open("Band4/" + name)
-                  test_band= raster.read(1)
-                  no_black_pix = np.where(band != 0)
-                  top = np.amin(no_black_pix[0])
-                  left = np.amin(no_black_pix[1])
-                  bottom = np.amax(no_black_pix[0])
-                  right = np.amax(no_black_pix[1])
-
-                  dst_width = right - left
-                  dst_height = bottom - top
-
-                  leftCoord, topCoord = src.xy(top, left, offset='ul')
-                  rightCoord, bottomCoord = src.xy(bottom, right, offset='lr')
-
-                  if self.index == 0:
-                     self.minBottom = bottomCoord
-                     self.minLeft = leftCoord
-                     self.maxTop = topCoord
-                     self.maxRight = rightCoord
-                     self.max_width = dst_width
-                     self.max_height = dst_height
-                     self.index += 1
-
-                  else:
-                     if bottomCoord < self.minBottom:
-                        self.minBottom = bottomCoord
-                     if leftCoord < self.minLeft:
-                        self.minLeft = leftCoord
-                     if rightCoord > self.maxRight:
-                        self.maxRight = rightCoord
-                     if topCoord > self.maxTop:
-                        self.maxTop = topCoord
-                     if dst_width > self.max_width:
-                        self.max_width = dst_width
-                     if dst_height > self.max_height:
-                        self.max_height = dst_height
-
-                  xres = meta['transform'][0]
-                  yres = -meta['transform'][4]
-                  dst_transform = affine.Affine(xres, 0.0, leftCoord, 0.0, -yres, topCoord)
-                  vrt_options = {
-                     'resampling': rst.enums.Resampling.cubic,
-                     'crs':dst_crs,
-                     'transform':dst_transform,
-                     'height':dst_height,
-                     'width':dst_width
-                  }
-                  with WarpedVRT(raster, **vrt_options) as vrt:
-                     rio_shutil.copy(vrt, "IntRegImgs/"+name, driver='GTiff')
-               raster.close()
-         except:
-            print("Could not open the file: ", name)
+      extent = read_roi_extent(image_path, band_num)
+      if extent is None:
+         print("Could not open the file: ", self.get_file_name(image_path))
+      elif extent != NO_EXTENT:
+         self.add_region(extent)
+      return extent
+
+   ###################################################
+   ##       Function: add_region                    ##
+   ## Grows the bounding box of all regions by one  ##
+   ## region extent. The width and height kept are  ##
+   ## the largest of any single region.             ##
+   ###################################################
+   def add_region(self, extent):
+      if self.index == 0:
+         self.minBottom = extent['bottom']
+         self.minLeft = extent['left']
+         self.maxTop = extent['top']
+         self.maxRight = extent['right']
+         self.max_width = extent['width']
+         self.max_height = extent['height']
+         self.index += 1
+
       else:
-         raster = rst.open("IntRegImgs/" + name)
-         test_band= raster.read(1)
-         leftCoord, topCoord = raster.xy(0, 0)
-         rightCoord, bottomCoord = raster.xy(test_band.shape[0]-1, test_band.shape[1]-1)
-
-         if self.index == 0:
-            self.minBottom = bottomCoord
-            self.minLeft = leftCoord
-            self.maxTop = topCoord
-            self.maxRight = rightCoord
-            self.max_width = dst_width
-            self.max_height = dst_height
-            self.index += 1
+         if extent['bottom'] < self.minBottom:
+            self.minBottom = extent['bottom']
+         if extent['left'] < self.minLeft:
+            self.minLeft = extent['left']
+         if extent['right'] > self.maxRight:
+            self.maxRight = extent['right']
+         if extent['top'] > self.maxTop:
+            self.maxTop = extent['top']
+         if extent['width'] > self.max_width:
+            self.max_width = extent['width']
+         if extent['height'] > self.max_height:
+            self.max_height = extent['height']
 
-         else:
-            if bottomCoord < self.minBottom:
-               self.minBottom = bottomCoord
-            if leftCoord < self.minLeft:
-               self.minLeft = leftCoord
-            if rightCoord > self.maxRight:
-               self.maxRight = rightCoord
-            if topCoord > self.maxTop:
-               self.maxTop = topCoord
-            if dst_width > self.max_width:
-               self.max_width = dst_width
-            if dst_height > self.max_height:
-               self.max_height = dst_height
+   ###################################################
+   ##       Function: get_roi_width_height          ##
+   ## Same as get_width_height, but the bounding    ##
+   ## box is built from the region of interest of   ##
+   ## band_num in every image. Region extents are   ##
+   ## kept in the extent index per band. All black  ##
+   ## images add no region.                         ##
+   ###################################################
+   def get_roi_width_height(self, path="Original_Images", band_num=4, index_path=None, num_threads=8):
+      print('Calculating Regions of Interest')
+      if index_path is None:
+         index_path = os.path.join(path, "extent_index.json")
+      image_paths = self.image_locations(path)
+      reader = partial(read_roi_extent, band_num=band_num)
+      extents = self.update_extent_index(image_paths, 'roi_' + str(band_num), reader, index_path, num_threads)
+      if len(extents) == 0:
+         print("No readable images in: ", path)
+         return None
+      self.index = 0
+      for extent in extents:
+         self.add_region(extent)
+      return self.minLeft, self.maxTop, self.maxRight, self.minBottom, self.max_width, self.max_height
 
    ###################################################
    ##       Function: compress_image                ##
@@ -278,10 +498,13 @@ class CompressImage:
    ## get_width_height is run. If you wish to make  ##
    ## the images smaller, you can modify the        ##
    ## dst_width and dst_height to change the image  ##
-   ## size.                                         ##
+   ## size. output and num_threads are as in        ##
+   ## compress_images. The manifest is shared       ##
+   ## between calls, so call save_manifest after    ##
+   ## the last image.                               ##
    ###################################################
    
-   def compress_image(self, image_path, save_directory, save=True):
+   def compress_image(self, image_path, save_directory, save=True, band_num=None, output=DEFAULT_PROFILE, num_threads=None):
       if not os.path.exists(save_directory):
          os.makedirs(save_directory)
       print("Compressing image ", self.IND)
@@ -289,29 +512,108 @@ class CompressImage:
       meta = ""
       name = self.get_file_name(image_path)
       band = []
-      if not os.path.exists(save_directory+"/"+name):
-         dst_crs = rst.crs.CRS.from_epsg(4326) # Coordinate system Hu Tzu Shan 1950
-         dst_width = self.max_width
-         dst_height = self.max_height
-
-         xres = (self.maxRight - self.minLeft) / dst_width
-         yres = (self.maxTop - self.minBottom) / dst_height
-         dst_transform = affine.Affine(xres, 0.0, self.minLeft, 0.0, -yres, self.maxTop)
-         vrt_options = {
-            'resampling': rst.enums.Resampling.cubic,
-            'crs':dst_crs,
-            'transform':dst_transform,
-            'height':dst_height,
-            'width':dst_width
-         }
-         if(save):
-            raster = rst.open(image_path)
-            with WarpedVRT(raster, **vrt_options) as vrt:
-               rio_shutil.copy(vrt, save_directory+"/"+name, driver='GTiff')
-               raster.close()
+      grid = self.target_grid()
+      manifest = self.stage_manifest(save_directory, grid, band_num, output)
+      if save and not manifest.is_current(image_path, save_directory+"/"+name):
+         warp_to_grid(image_path, save_directory+"/"+name, grid, band_num, output, num_threads)
+         manifest.record(image_path, save_directory+"/"+name)
       
       return name, band, meta
 
+   ###################################################
+   ##       Function: stage_manifest                ##
+   ## Returns the manifest of save_directory for    ##
+   ## the grid, band and output profile, reusing it ##
+   ## while they stay the same.                     ##
+   ###################################################
+   def stage_manifest(self, save_directory, grid, band_num=None, output=DEFAULT_PROFILE):
+      # round trip through json so the grid's tuple compares equal to the manifest's list
+      params = json.loads(json.dumps({'band': band_num, 'grid': grid, 'output': output}))
+      if self.manifest is None or self.manifest.path != save_directory + "/manifest.json" or self.manifest.params != params:
+         self.save_manifest()
+         self.manifest = Manifest(save_directory, "compress", params)
+      return self.manifest
+
+   ###################################################
+   ##       Function: save_manifest                 ##
+   ## Writes out the manifest of the images saved   ##
+   ## by compress_image and compress_images.        ##
+   ###################################################
+   def save_manifest(self):
+      if self.manifest is not None:
+         self.manifest.save()
+
+   ###################################################
+   ##       Function: target_grid                   ##
+   ## Returns the shared grid every image is warped ##
+   ## onto, built from minLeft/maxTop/maxRight/     ##
+   ## minBottom and max_width/max_height. The grid  ##
+   ## is a plain dictionary so it can be sent to    ##
+   ## worker processes.                             ##
+   ###################################################
+   def target_grid(self):
+      dst_width = self.max_width
+      dst_height = self.max_height
+      xres = (self.maxRight - self.minLeft) / dst_width
+      yres = (self.maxTop - self.minBottom) / dst_height
+      return {
+         'transform': (xres, 0.0, self.minLeft, 0.0, -yres, self.maxTop),
+         'width': dst_width,
+         'height': dst_height
+      }
+
+   ###################################################
+   ##       Function: compress_images               ##
+   ## Compresses a list of images onto the shared   ##
+   ## grid. With num_workers greater than 1 the     ##
+   ## images are spread over a process pool, where  ##
+   ## each worker opens its own dataset. Output is  ##
+   ## identical to compress_image since both use    ##
+   ## warp_to_grid. Returns a list of               ##
+   ## (image_path, error) for images that failed.   ##
+   ## If band_num is given, only the scaled band is ##
+   ## warped (see warp_to_grid). Images already     ##
+   ## compressed from the same input onto the same  ##
+   ## grid, according to the save_directory         ##
+   ## manifest, are skipped. output is the name of  ##
+   ## the OutputProfile to write with, and          ##
+   ## num_threads the number of threads GDAL may    ##
+   ## compress each image with.                     ##
+   ###################################################
+   def compress_images(self, image_paths, save_directory, num_workers=1, band_num=None, output=DEFAULT_PROFILE, num_threads=None):
+      if not os.path.exists(save_directory):
+         os.makedirs(save_directory)
+      grid = self.target_grid()
+      manifest = self.stage_manifest(save_directory, grid, band_num, output)
+      tasks = []
+      for image_path in image_paths:
+         save_path = save_directory + "/" + self.get_file_name(image_path)
+         if not manifest.is_current(image_path, save_path):
+            tasks.append((image_path, save_path, grid, band_num, output, num_threads))
+      print("Compressing {} of {} images with {} worker(s)".format(len(tasks), len(image_paths), num_workers))
+
+      failures = []
+      executor = None
+      results = map(compress_worker, tasks)
+      if num_workers > 1:
+         executor = ProcessPoolExecutor(max_workers=num_workers)
+         results = executor.map(compress_worker, tasks)
+      for image_path, error in results:
+         print("Compressing image ", self.IND)
+         self.IND += 1
+         if error is not None:
+            failures.append((image_path, error))
+         else:
+            manifest.record(image_path, save_directory + "/" + self.get_file_name(image_path))
+      if executor is not None:
+         executor.shutdown()
+      manifest.save()
+
+      for image_path, error in failures:
+         print("Could not compress the file: ", image_path)
+         print(error)
+      return failures
+
 
 
 def main():
@@ -327,11 +629,19 @@ def main():
       print("")    
       if(user_input == '1'):
          print("To compress images you can use the following command line arguments: ")
-         print("compress [directory to compress] [save directory] [band number]\n")
+         print("compress [directory to compress] [save directory] [band number] [number of workers (optional)] [fast/balanced/archival (optional)]\n")
          print("Example:\t python CompressImage.py compress OriginalImages CompressedImages 4\n")
+         print("Example:\t python CompressImage.py compress OriginalImages CompressedImages 4 8\n")
+         print("Example:\t python CompressImage.py compress OriginalImages CompressedImages 4 8 archival\n")
 
    else:
-      if sys.argv[1].lower() == "compress" and len(sys.argv) == 5:
+      if sys.argv[1].lower() == "compress" and len(sys.argv) in (5, 6, 7):
+         num_workers = 1
+         if len(sys.argv) >= 6:
+            num_workers = int(sys.argv[5])
+         output = DEFAULT_PROFILE
+         if len(sys.argv) == 7:
+            output = sys.argv[6].lower()
          left = 0
          top = 0
          right = 0
@@ -340,61 +650,11 @@ def main():
          height = 0
          
          print("Compressing Images...")
-         imageLocations = ci.image_locations(path=sys.argv[2])
-         last_filename = ci.get_file_name(imageLocations[0])
-         
-         if os.path.exists("imgDim.txt") and os.path.exists("IntRegImgs"):
-            dimFile = open("imgDim.txt", "r+")
-            ci.minLeft = float(dimFile.readline()[6:-1])
-            ci.maxTop = float(dimFile.readline()[5:-1])
-            ci.maxRight = float(dimFile.readline()[7:-1])
-            ci.minBottom = float(dimFile.readline()[8:-1])
-            ci.max_width = int(dimFile.readline()[7:-1])
-            ci.max_height = int(dimFile.readline()[8:])
-            dimFile.close()
-            for image_path in ci.image_locations(path="IntRegImgs"):
-               ci.compress_image(image_path, sys.argv[3])
-
-         elif os.path.exists("IntRegImgs") and not os.path.exists("Band4" + last_filename):
-            for image_path in imageLocations:
-               ci.region_of_interest(image_path, int(sys.argv[4]))
-            dimFile = open("imgDim.txt", "a+")
-            dimFile.write("left: %f\n" % ci.minLeft)
-            dimFile.write("top: %f\n" % ci.maxTop)
-            dimFile.write("right: %f\n" % ci.maxRight)
-            dimFile.write("bottom: %f\n" % ci.minBottom)
-            dimFile.write("width: %d\n" % ci.max_width)
-            dimFile.write("height: %d" % ci.max_height)
-            dimFile.close()     
-            for image_path in ci.image_locations(path="IntRegImgs"):
-               ci.compress_image(image_path, sys.argv[3])
-         elif os.path.exists("IntRegImgs"):
-            ci.get_width_height("IntRegImgs")
-            dimFile = open("imgDim.txt", "a+")
-            dimFile.write("left: %f\n" % ci.minLeft)
-            dimFile.write("top: %f\n" % ci.maxTop)
-            dimFile.write("right: %f\n" % ci.maxRight)
-            dimFile.write("bottom: %f\n" % ci.minBottom)
-            dimFile.write("width: %d\n" % ci.max_width)
-            dimFile.write("height: %d" % ci.max_height)
-            dimFile.close()   
-            for image_path in ci.image_locations(path="IntRegImgs"):
-               ci.compress_image(image_path, sys.argv[3])
-         else:
-            for image_path in ci.image_locations(path=sys.argv[2]):
-               ci.region_of_interest(image_path, int(sys.argv[4]))
-            dimFile = open("imgDim.txt", "a+")
-            dimFile.write("left: %f\n" % ci.minLeft)
-            dimFile.write("top: %f\n" % ci.maxTop)
-            dimFile.write("right: %f\n" % ci.maxRight)
-            dimFile.write("bottom: %f\n" % ci.minBottom)
-            dimFile.write("width: %d\n" % ci.max_width)
-            dimFile.write("height: %d" % ci.max_height)
-            dimFile.close()     
-            for image_path in ci.image_locations(path="IntRegImgs"):
-               ci.compress_image(image_path, sys.argv[3])
-
-      elif sys.argv[1].lower() == "compress" and len(sys.argv) != 4:
+         band_num = int(sys.argv[4])
+         ci.get_roi_width_height(sys.argv[2], band_num, sys.argv[3] + "/extent_index.json")
+         ci.compress_images(ci.image_locations(path=sys.argv[2]), sys.argv[3], num_workers, band_num, output)
+
+      elif sys.argv[1].lower() == "compress" and len(sys.argv) not in (5, 6, 7):
          print("To compress images please enter: compress [directory to compress] [save directory] [band number]\n")
       elif(len(sys.argv) > 2):
          print("To compress images please enter: compress [directory to compress] [save directory] [band number]\n")
@@ -2,16 +2,58 @@ import numpy as np
 import os
 import sys
 from pathlib import Path
-from osgeo import gdal
-import rasterio as rst
-import matplotlib.pyplot as plt
-import cv2 as cv
-from scipy.ndimage import gaussian_filter
-from skimage import measure
-from scipy.stats import itemfreq
-import matplotlib.animation as animation
-from MP4Maker import MP4Maker
-import cc3d
+from Manifest import Manifest
+from Instrumentation import span, file_size
+
+
+###################################################
+##       Class: UnionFind                        ##
+## Union-find over integer labels, stored in a   ##
+## numpy array so it can grow as new labels are  ##
+## handed out. The array at least doubles when   ##
+## it grows, so growing one frame at a time      ##
+## stays cheap. The smaller label of a set is    ##
+## always its root.                              ##
+###################################################
+class UnionFind:
+   def __init__(self, size=1):
+      self.parent = np.arange(size, dtype=np.int64)
+
+   def grow(self, size):
+      if size > len(self.parent):
+         size = max(size, 2 * len(self.parent))
+         self.parent = np.concatenate((self.parent, np.arange(len(self.parent), size, dtype=np.int64)))
+
+   def find(self, label):
+      parent = self.parent
+      while parent[label] != label:
+         parent[label] = parent[parent[label]]
+         label = parent[label]
+      return label
+
+   def union(self, label_a, label_b):
+      root_a = self.find(label_a)
+      root_b = self.find(label_b)
+      if root_a < root_b:
+         self.parent[root_b] = root_a
+      elif root_b < root_a:
+         self.parent[root_a] = root_b
+      return min(root_a, root_b)
+
+   ###################################################
+   ##       Function: roots                         ##
+   ## Root of every label, found for all labels at  ##
+   ## once by pointer jumping.                      ##
+   ###################################################
+   def roots(self):
+      roots = self.parent
+      while True:
+         next_roots = roots[roots]
+         if np.array_equal(next_roots, roots):
+            self.parent = roots
+            return roots
+         roots = next_roots
+
 
 class ConnectedComp:
    ###################################################
@@ -32,46 +74,442 @@ class ConnectedComp:
       index_slash = image_path.rfind('/')
       return image_path[index_slash+1:len(image_path)]
 
-   def apply_connected_comp(self, apply_directory, save_directory, num_components=100, num_images = 200):
+   ###################################################
+   ##       Function: read_frames                   ##
+   ## Yields (name, image, transform) for the first ##
+   ## num_images k-means images in the directory,   ##
+   ## in file name order.                           ##
+   ###################################################
+   def read_frames(self, apply_directory, num_images = 200):
+      import rasterio as rst
+      image_paths = np.sort(self.image_locations(apply_directory))
+      for image_path in image_paths[:num_images]:
+         name = self.get_file_name(image_path)
+         with span("read", frame=name, bytes_read=file_size(image_path)):
+            raster = rst.open(image_path)
+            profile = raster.profile
+            image = raster.read(1)
+            raster.close()
+         yield name, image, profile['transform']
+
+   ###################################################
+   ##       Function: apply_connected_comp          ##
+   ## Applies connected components to a directory   ##
+   ## of k-means images. With chunk_size set, the   ##
+   ## frames are labeled chunk_size at a time (see  ##
+   ## connect_frames_chunked). Nothing is done if   ##
+   ## the manifest next to save_directory shows the ##
+   ## outputs were made from the same images with   ##
+   ## the same settings.                            ##
+   ###################################################
+   def apply_connected_comp(self, apply_directory, save_directory, num_components=100, num_images = 200, chunk_size=None):
+      params = {'num_components': int(num_components), 'num_images': num_images, 'chunk_size': chunk_size}
+      manifest = Manifest(os.path.dirname(save_directory) or ".", "connected_components " + os.path.basename(save_directory), params)
+      outputs = [save_directory + suffix for suffix in (".npy", "_names.npy", "_meta.npy", "_components.npy")]
+      if manifest.is_current(apply_directory, outputs):
+         print("Connected components are up to date: " + save_directory)
+         return
+      frames = self.read_frames(apply_directory, num_images)
+      if chunk_size is None:
+         self.connect_frames(frames, save_directory, num_components, num_images)
+      else:
+         self.connect_frames_chunked(frames, save_directory, num_components, num_images, chunk_size)
+      manifest.record(apply_directory, outputs)
+      manifest.save()
+
+   ###################################################
+   ##       Function: compare_chunked               ##
+   ## Labels every k-means image in apply_directory ##
+   ## both with connect_frames and with             ##
+   ## connect_frames_chunked, into work_directory,  ##
+   ## and compares the saved labels and component   ##
+   ## tables. Centroids are sums in a different     ##
+   ## order, so they only have to agree to within   ##
+   ## rounding.                                     ##
+   ###################################################
+   def compare_chunked(self, apply_directory, work_directory, num_components=100, chunk_size=32):
+      num_components = int(num_components)
+      whole = work_directory + "/whole"
+      chunked = work_directory + "/chunked"
+      self.connect_frames(self.read_frames(apply_directory, None), whole, num_components, None)
+      self.connect_frames_chunked(self.read_frames(apply_directory, None), chunked, num_components, None, chunk_size)
+      whole_labels = np.load(whole + ".npy", mmap_mode='r')
+      chunked_labels = np.load(chunked + ".npy", mmap_mode='r')
+      whole_table = np.load(whole + "_components.npy")
+      chunked_table = np.load(chunked + "_components.npy")
+      same_fields = whole_table.dtype == chunked_table.dtype and len(whole_table) == len(chunked_table)
+      centroid_difference = None
+      if same_fields:
+         for field in whole_table.dtype.names:
+            if np.issubdtype(whole_table.dtype[field], np.floating):
+               difference = float(np.abs(whole_table[field] - chunked_table[field]).max(initial=0))
+               centroid_difference = max(centroid_difference or 0.0, difference)
+               same_fields = same_fields and np.allclose(whole_table[field], chunked_table[field])
+            else:
+               same_fields = same_fields and np.array_equal(whole_table[field], chunked_table[field])
+      return {
+         'frames': int(whole_labels.shape[0]),
+         'chunk_size': int(chunk_size),
+         'labels_identical': bool(whole_labels.shape == chunked_labels.shape and np.array_equal(whole_labels, chunked_labels)),
+         'components_identical': bool(same_fields),
+         'components_kept': int(len(whole_table)),
+         'max_float_difference': centroid_difference,
+         'names_identical': bool(np.array_equal(np.load(whole + "_names.npy"), np.load(chunked + "_names.npy"))),
+         'meta_identical': bool(np.array_equal(np.load(whole + "_meta.npy", allow_pickle=True), np.load(chunked + "_meta.npy", allow_pickle=True)))
+      }
+
+   ###################################################
+   ##       Function: meta_header                   ##
+   ## Column names of the meta npy file.            ##
+   ###################################################
+   def meta_header(self):
+      return ['driver', 'dtype', 'nodata', 'width', 'height', 'count', 'crs', 'pixel width', 'row rotation', 'upperleftx_coord', 'column rotation', 'pixel height','upperlefty_coord', 'blockxsize', 'blockysize', 'tiled', 'compress', 'interleave']
+
+   ###################################################
+   ##       Function: frame_meta                    ##
+   ## Row of the meta npy file for one frame of     ##
+   ## the given height and width.                   ##
+   ###################################################
+   def frame_meta(self, pixel_transform, height, width):
+      return ['GTiff', 'uint8', 0.0, width, height, 1, 'epsg:4326', pixel_transform[0], pixel_transform[1], pixel_transform[2], pixel_transform[3], pixel_transform[4], pixel_transform[5], 256, 256, True, 'deflate', 'band']
+
+   ###################################################
+   ##       Function: connect_frames                ##
+   ## Applies 3d connected components to an         ##
+   ## iterable of (name, image, transform) frames,  ##
+   ## where the images are k-means output (0/255),  ##
+   ## and saves the labels, names and meta as npy   ##
+   ## files. The frames can come from disk          ##
+   ## (read_frames) or straight from k-means. They  ##
+   ## are stacked into one preallocated uint8       ##
+   ## volume, and cc3d writes its labels to a       ##
+   ## memory mapped file instead of RAM. Only the   ##
+   ## num_components largest components are kept,   ##
+   ## and their statistics are saved as a table in  ##
+   ## a components npy file.                        ##
+   ###################################################
+   def connect_frames(self, frames, save_directory, num_components=100, num_images = 200):
       index_slash = save_directory.rfind('/')
       directory = save_directory[0:index_slash]
       print("Applying Connected Components...")
       if not os.path.exists(directory):
          os.makedirs(directory)    
       file_names = []
-      images = []
       meta = []
-      meta.append(['driver', 'dtype', 'nodata', 'width', 'height', 'count', 'crs', 'pixel width', 'row rotation', 'upperleftx_coord', 'column rotation', 'pixel height','upperlefty_coord', 'blockxsize', 'blockysize', 'tiled', 'compress', 'interleave'])
+      meta.append(self.meta_header())
+      images = None
       image_num = 0
-      for image_path in self.image_locations(apply_directory):
-         if image_num < num_images:
-            name = self.get_file_name(image_path)
-            raster = rst.open(image_path)
-            profile = raster.profile
-            image = raster.read(1)
-            image[image == 255] = 1
-            file_names.append(name)
-            images.append(image)
-            pixel_transform = profile['transform']
-            meta.append(['GTiff', 'uint8', 0.0, 2462, 3500, 1, 'epsg:4326', pixel_transform[0], pixel_transform[1], pixel_transform[2], pixel_transform[3], pixel_transform[4], pixel_transform[5], 256, 256, True, 'deflate', 'band'])
-            image_num += 1
+      for name, image, pixel_transform in frames:
+         if num_images is not None and image_num >= num_images:
+            break
+         if images is None:
+            capacity = num_images if num_images is not None else 64
+            images = np.zeros((capacity,) + image.shape, dtype=np.uint8)
+         elif image_num == len(images):
+            images = np.concatenate((images, np.zeros_like(images)))
+         images[image_num] = image != 0
+         file_names.append(name)
+         meta.append(self.frame_meta(pixel_transform, image.shape[0], image.shape[1]))
+         image_num += 1
+      if images is None:
+         print("No images to connect.")
+         return
+      images = images[:image_num]
       file_names = np.asarray(file_names)
-      images = np.asarray(images)
       print(meta[0])
       meta = np.asarray(meta)
       connectivity = 6 
       print("Connecting Components...")
-      labeled_data = cc3d.connected_components(images, connectivity=connectivity)
-      print(np.unique(labeled_data))
-      labeled_data[labeled_data > int(num_components)] = 0
+      import cc3d
+      temp_path = save_directory + "_provisional.tmp"
+      with span("label", frames=image_num):
+         labeled_data, count = cc3d.connected_components(images, connectivity=connectivity, return_N=True, out_dtype=np.uint32, out_file=temp_path)
+      del images
+      print("Number of components: ", count)
+      with span("statistics", components=int(count)):
+         stats = self.label_statistics(labeled_data)
+         lookup, table = self.select_components(stats, int(num_components))
 
       print("Saving Images...")
-      np.save(save_directory + ".npy", labeled_data)
+      with span("write", frames=image_num) as fields:
+         self.save_labels(labeled_data, lookup, save_directory)
+         fields['bytes_written'] = file_size(save_directory + ".npy")
+      del labeled_data
+      os.remove(temp_path)
+      print("Saving Components...")
+      np.save(save_directory + "_components.npy", table)
       print("Saving Names...")
       np.save(save_directory + "_names.npy", file_names)
       print("Saving Meta...")
       np.save(save_directory + "_meta.npy", meta)
 
+   ###################################################
+   ##       Function: save_labels                   ##
+   ## Writes lookup[provisional] to save_directory  ##
+   ## .npy through a memory map, a few frames at a  ##
+   ## time. The file uses the smallest unsigned     ##
+   ## dtype that holds the largest kept label.      ##
+   ###################################################
+   def save_labels(self, provisional, lookup, save_directory, chunk_size=32):
+      dtype = np.min_scalar_type(int(lookup.max()))
+      lookup = lookup.astype(dtype)
+      labeled_data = np.lib.format.open_memmap(save_directory + ".npy", mode='w+', dtype=dtype, shape=provisional.shape)
+      for start in range(0, len(provisional), chunk_size):
+         labeled_data[start:start + chunk_size] = lookup[provisional[start:start + chunk_size]]
+      labeled_data.flush()
+      del labeled_data
+
+   ###################################################
+   ##       Function: connect_frames_chunked        ##
+   ## Same output as connect_frames, but only       ##
+   ## chunk_size frames are in memory at a time, so ##
+   ## num_images can be None (every frame). Each    ##
+   ## chunk is labeled on its own and its labels    ##
+   ## are offset to be unique. Labels that touch    ##
+   ## across the boundary slices of two chunks are  ##
+   ## joined in a union-find. The provisional       ##
+   ## labels go to a temporary file, and a second   ##
+   ## pass rewrites them chunk by chunk with the    ##
+   ## final labels, numbered by first appearance    ##
+   ## like the labeling of the whole volume.        ##
+   ###################################################
+   def connect_frames_chunked(self, frames, save_directory, num_components=100, num_images=None, chunk_size=32):
+      index_slash = save_directory.rfind('/')
+      directory = save_directory[0:index_slash]
+      print("Applying Connected Components in chunks of {} frames...".format(chunk_size))
+      if not os.path.exists(directory):
+         os.makedirs(directory)
+      file_names = []
+      meta = [self.meta_header()]
+      union_find = UnionFind()
+      chunk_stats = []
+      num_labels = 0
+      last_slice = None
+      frame_shape = None
+      temp_path = save_directory + "_provisional.tmp"
+      temp_file = open(temp_path, "wb")
+
+      chunk = None
+      chunk_frames = 0
+      image_num = 0
+      for name, image, pixel_transform in frames:
+         if num_images is not None and image_num >= num_images:
+            break
+         if chunk is None:
+            frame_shape = image.shape
+            chunk = np.zeros((chunk_size,) + frame_shape, dtype=np.uint8)
+         chunk[chunk_frames] = image != 0
+         chunk_frames += 1
+         file_names.append(name)
+         meta.append(self.frame_meta(pixel_transform, image.shape[0], image.shape[1]))
+         image_num += 1
+         if chunk_frames == chunk_size:
+            num_labels, last_slice = self.label_chunk(chunk, image_num - chunk_frames, union_find, num_labels, last_slice, temp_file, chunk_stats)
+            chunk_frames = 0
+      if image_num == 0:
+         temp_file.close()
+         os.remove(temp_path)
+         print("No images to connect.")
+         return
+      if chunk_frames > 0:
+         num_labels, last_slice = self.label_chunk(chunk[:chunk_frames], image_num - chunk_frames, union_find, num_labels, last_slice, temp_file, chunk_stats)
+      temp_file.close()
+
+      print("Joining Components Across Chunks...")
+      union_find.grow(num_labels + 1)
+      roots = union_find.roots()[:num_labels + 1]
+      is_root = roots == np.arange(len(roots))
+      joined = (np.cumsum(is_root) - 1)[roots]
+      print("Number of components: ", int(joined.max()))
+      stats = self.join_statistics(chunk_stats, joined)
+      lookup, table = self.select_components(stats, int(num_components))
+      lookup = lookup[joined]
+
+      print("Saving Images...")
+      provisional = np.memmap(temp_path, dtype=np.uint32, mode='r', shape=(image_num,) + frame_shape)
+      self.save_labels(provisional, lookup, save_directory, chunk_size)
+      del provisional
+      os.remove(temp_path)
+      print("Saving Components...")
+      np.save(save_directory + "_components.npy", table)
+
+      print("Saving Names...")
+      np.save(save_directory + "_names.npy", np.asarray(file_names))
+      print("Saving Meta...")
+      np.save(save_directory + "_meta.npy", np.asarray(meta))
+
+   ###################################################
+   ##       Function: label_chunk                   ##
+   ## Labels one chunk of binary frames starting at ##
+   ## frame first_frame, offsets its labels past    ##
+   ## num_labels, joins them to the last slice of   ##
+   ## the previous chunk and appends them to        ##
+   ## temp_file. The chunk's label statistics are   ##
+   ## added to chunk_stats. Returns the new number  ##
+   ## of labels and the chunk's last labeled slice. ##
+   ###################################################
+   def label_chunk(self, chunk, first_frame, union_find, num_labels, last_slice, temp_file, chunk_stats):
+      import cc3d
+      with span("label", first_frame=first_frame, frames=len(chunk)):
+         labels, count = cc3d.connected_components(chunk, connectivity=6, return_N=True, out_dtype=np.uint32)
+      stats = self.label_statistics(labels, first_frame)
+      for field in stats:
+         stats[field] = stats[field][1:]
+      chunk_stats.append(stats)
+      labels[labels != 0] += np.uint32(num_labels)
+      if last_slice is not None:
+         touching = (last_slice != 0) & (labels[0] != 0)
+         pairs = np.unique(np.stack((last_slice[touching], labels[0][touching]), axis=1), axis=0)
+         union_find.grow(num_labels + count + 1)
+         for label_a, label_b in pairs:
+            union_find.union(int(label_a), int(label_b))
+      temp_file.write(labels.tobytes())
+      return num_labels + count, labels[-1].copy()
+
+   ###################################################
+   ##       Function: label_statistics              ##
+   ## Voxel count, inclusive bounding box and       ##
+   ## centroid of every label, in one cc3d pass.    ##
+   ## Returns a dictionary of arrays indexed by     ##
+   ## label, with frames offset by first_frame.     ##
+   ###################################################
+   def label_statistics(self, labels, first_frame=0):
+      import cc3d
+      stats = cc3d.statistics(labels, no_slice_conversion=True)
+      boxes = stats['bounding_boxes'].astype(np.int64)
+      centroids = stats['centroids']
+      return {
+         'voxel_count': stats['voxel_counts'].astype(np.int64),
+         'first_frame': boxes[:, 0] + first_frame,
+         'last_frame': boxes[:, 1] + first_frame,
+         'top': boxes[:, 2],
+         'bottom': boxes[:, 3],
+         'left': boxes[:, 4],
+         'right': boxes[:, 5],
+         'centroid_frame': centroids[:, 0] + first_frame,
+         'centroid_row': centroids[:, 1],
+         'centroid_col': centroids[:, 2]
+      }
+
+   ###################################################
+   ##       Function: join_statistics               ##
+   ## Combines the statistics of every chunk's      ##
+   ## labels into statistics of the joined labels.  ##
+   ## joined maps each provisional label to its     ##
+   ## joined label.                                 ##
+   ###################################################
+   def join_statistics(self, chunk_stats, joined):
+      provisional = {}
+      for field in chunk_stats[0]:
+         provisional[field] = np.concatenate([stats[field] for stats in chunk_stats])
+      joined = joined[1:]
+      size = int(joined.max()) + 1 if len(joined) > 0 else 1
+      counts = provisional['voxel_count']
+      stats = {'voxel_count': np.bincount(joined, weights=counts, minlength=size).astype(np.int64)}
+      for field in ('first_frame', 'top', 'left'):
+         stats[field] = np.full(size, np.iinfo(np.int64).max, dtype=np.int64)
+         np.minimum.at(stats[field], joined, provisional[field])
+      for field in ('last_frame', 'bottom', 'right'):
+         stats[field] = np.full(size, -1, dtype=np.int64)
+         np.maximum.at(stats[field], joined, provisional[field])
+      with np.errstate(invalid='ignore', divide='ignore'):
+         for field in ('centroid_frame', 'centroid_row', 'centroid_col'):
+            stats[field] = np.bincount(joined, weights=provisional[field] * counts, minlength=size) / stats['voxel_count']
+      # same field order as label_statistics, so both tables have one dtype
+      return {field: stats[field] for field in provisional}
+
+   ###################################################
+   ##       Function: select_components             ##
+   ## Keeps the num_components largest components.  ##
+   ## Returns a lookup table from label to kept     ##
+   ## label (1 is the largest, 0 is dropped) and a  ##
+   ## table of the kept components' statistics.     ##
+   ###################################################
+   def select_components(self, stats, num_components):
+      counts = stats['voxel_count']
+      order = np.argsort(-counts[1:], kind='stable')[:num_components] + 1
+      lookup = np.zeros(len(counts), dtype=np.uint32)
+      lookup[order] = np.arange(1, len(order) + 1, dtype=np.uint32)
+
+      fields = [('label', np.uint32)]
+      for field in stats:
+         fields.append((field, np.float64 if field.startswith('centroid') else np.int64))
+      table = np.zeros(len(order), dtype=fields)
+      table['label'] = lookup[order]
+      for field in stats:
+         table[field] = stats[field][order]
+      return lookup, table
+
+   ###################################################
+   ##       Function: start_incremental             ##
+   ## Starts labeling frames one at a time as they  ##
+   ## arrive with append_frame, instead of labeling ##
+   ## the whole stack at once.                      ##
+   ###################################################
+   def start_incremental(self):
+      self.incremental_union_find = UnionFind()
+      self.incremental_num_labels = 0
+      self.incremental_last_slice = None
+
+   ###################################################
+   ##       Function: append_frame                  ##
+   ## Labels one new k-means frame in 2D and links  ##
+   ## it to the previous frame, which together is   ##
+   ## 6-connectivity in 3D. A component that        ##
+   ## touches a labeled component of the previous   ##
+   ## frame takes its label, otherwise it gets a    ##
+   ## new one, so the cost per frame does not grow  ##
+   ## with the flight. Returns the frame's labels   ##
+   ## and a list of (old label, new label) for      ##
+   ## fires that merged in this frame. Only frames  ##
+   ## already returned that hold an old label need  ##
+   ## rewriting, e.g. with current_labels.          ##
+   ###################################################
+   def append_frame(self, image):
+      import cc3d
+      union_find = self.incremental_union_find
+      first_label = self.incremental_num_labels
+      labels, count = cc3d.connected_components((image != 0).astype(np.uint8), connectivity=4, return_N=True, out_dtype=np.uint32)
+      union_find.grow(first_label + count + 1)
+
+      merges = []
+      last_slice = self.incremental_last_slice
+      if last_slice is not None:
+         touching = (last_slice != 0) & (labels != 0)
+         pairs = np.unique(np.stack((last_slice[touching], labels[touching] + first_label), axis=1), axis=0)
+         for old_label, new_label in pairs:
+            old_root = union_find.find(int(old_label))
+            new_root = union_find.find(int(new_label))
+            if old_root == new_root:
+               continue
+            if new_root <= first_label:
+               # The new component already belongs to an earlier fire, so two fires merge
+               merges.append((max(old_root, new_root), min(old_root, new_root)))
+            union_find.union(old_root, new_root)
+
+      roots = union_find.parent[first_label + 1:first_label + count + 1]
+      while True:
+         next_roots = union_find.parent[roots]
+         if np.array_equal(next_roots, roots):
+            break
+         roots = next_roots
+      lookup = np.concatenate(([0], roots)).astype(np.uint32)
+      frame_labels = lookup[labels]
+
+      self.incremental_num_labels = first_label + count
+      self.incremental_last_slice = frame_labels
+      return frame_labels, merges
+
+   ###################################################
+   ##       Function: current_labels                ##
+   ## Rewrites labels returned by earlier calls to  ##
+   ## append_frame to their current labels, after   ##
+   ## fires have merged.                            ##
+   ###################################################
+   def current_labels(self, labels):
+      roots = self.incremental_union_find.roots()
+      return roots[labels].astype(labels.dtype)
+
 def main():
    print("Notice: You can run all processes at once using Main.py. If you run scripts individually please note that this script is intended to run after KMeansConverter.py. If it is executed after a different script it will not work.")
    cc = ConnectedComp()
@@ -79,10 +517,17 @@ def main():
       print("Please enter the directory of the images you would like to compress and the new directory for the compressed images.")
    elif sys.argv[1].lower() == "cc" and len(sys.argv) == 5:
       cc.apply_connected_comp(sys.argv[2], sys.argv[3], sys.argv[4])
-   elif sys.argv[1].lower() == "cc" and len(sys.argv) != 5:
+   elif sys.argv[1].lower() == "cc" and len(sys.argv) == 6:
+      cc.apply_connected_comp(sys.argv[2], sys.argv[3], sys.argv[4], None, int(sys.argv[5]))
+   elif sys.argv[1].lower() == "chunkcheck" and len(sys.argv) == 6:
+      print(cc.compare_chunked(sys.argv[2], sys.argv[3], sys.argv[4], int(sys.argv[5])))
+   elif sys.argv[1].lower() == "cc" and len(sys.argv) not in (5, 6):
       print("To apply connected components to images please enter: cc image_directory_to_apply save_directory number_components")
+      print("To label every image a few frames at a time please enter: cc image_directory_to_apply save_directory number_components chunk_size")
+      print("To check that labeling in chunks matches labeling all frames at once please enter: chunkcheck image_directory_to_apply work_directory number_components chunk_size")
    else:
       print("To apply connected components to images please enter: cc image_directory_to_apply save_directory")
+      print("To check that labeling in chunks matches labeling all frames at once please enter: chunkcheck image_directory_to_apply work_directory number_components chunk_size")
 
 if __name__ == "__main__":
    main()
\ No newline at end of file
@@ -2,14 +2,223 @@ import numpy as np
 import os
 import sys
 from pathlib import Path
-import matplotlib.pyplot as plt
-import cv2 as cv
-import matplotlib.animation as animation
-from shapely.geometry import mapping, Point, MultiPoint, MultiPolygon, Polygon #LineString, MultiLineString
-import fiona
-import geopandas as gpd
-from fiona.crs import from_epsg
-import shapefile as shp
+import re
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+from WorkerPool import bounded_map
+from FrameVideoWriter import FrameVideoWriter
+from Manifest import Manifest
+from Instrumentation import span, file_size
+
+# cv.findContours retrieval modes by name. ccomp keeps holes as polygon interiors
+RETRIEVAL_MODES = {'tree': 'RETR_TREE', 'external': 'RETR_EXTERNAL', 'ccomp': 'RETR_CCOMP'}
+
+###################################################
+##       Function: contours_to_polygons          ##
+## Turns OpenCV contours longer than min_points  ##
+## into polygons, keeping every step-th point of ##
+## each contour. Contours left with fewer than 3 ##
+## points are dropped. All rings are built with  ##
+## one call to shapely's vectorized              ##
+## constructors. If transform (a, b, c, d, e, f) ##
+## is given, the pixel centers are converted to  ##
+## map coordinates first. If the hierarchy of a  ##
+## RETR_CCOMP search is given, holes become the  ##
+## interiors of their outer contour's polygon.   ##
+###################################################
+def contours_to_polygons(contours, min_points=400, step=15, transform=None, hierarchy=None):
+   import shapely
+   rings = []
+   kept = []
+   for index, contour in enumerate(contours):
+      if len(contour) > min_points:
+         points = contour[step - 1::step, 0, :]
+         if len(points) >= 3:
+            rings.append(points)
+            kept.append(index)
+   if len(rings) == 0:
+      return []
+   coords = np.concatenate(rings).astype(np.float64)
+   if transform is not None:
+      coords = pixels_to_map(coords, transform)
+   indices = np.repeat(np.arange(len(rings)), [len(ring) for ring in rings])
+   rings = shapely.linearrings(coords, indices=indices)
+   if hierarchy is None:
+      return list(shapely.polygons(rings))
+
+   parents = hierarchy[0][kept, 3]
+   ring_of = dict(zip(kept, range(len(kept))))
+   holes = {}
+   for ring, parent in enumerate(parents):
+      if parent >= 0 and parent in ring_of:
+         holes.setdefault(ring_of[parent], []).append(rings[ring])
+   return [shapely.polygons(rings[ring], holes=holes.get(ring)) for ring, parent in enumerate(parents) if parent < 0]
+
+
+###################################################
+##       Function: pixels_to_map                 ##
+## Converts an N x 2 array of (column, row)      ##
+## pixel coordinates to the centers of those     ##
+## pixels in map coordinates, using the affine   ##
+## transform (a, b, c, d, e, f) from the meta    ##
+## npy file.                                     ##
+###################################################
+def pixels_to_map(coords, transform):
+   a, b, c, d, e, f = transform
+   cols = coords[:, 0] + 0.5
+   rows = coords[:, 1] + 0.5
+   return np.column_stack((a * cols + b * rows + c, d * cols + e * rows + f))
+
+
+###################################################
+##       Function: open_label_volume             ##
+## Opens the label volume contour_frame reads    ##
+## from, memory mapped so frames are only read   ##
+## from disk as they are contoured. Also the     ##
+## initializer of the worker processes, so the   ##
+## volume is never copied to them.               ##
+###################################################
+label_volume = None
+frame_buffer = None
+def open_label_volume(path):
+   global label_volume
+   label_volume = np.load(path, mmap_mode='r')
+
+
+###################################################
+##       Function: frame_bounds                  ##
+## Returns the (top, bottom, left, right) rows   ##
+## and columns, inclusive, holding every label   ##
+## of the frame, or None if the frame is empty.  ##
+###################################################
+def frame_bounds(frame):
+   rows = np.flatnonzero(frame.any(axis=1))
+   if len(rows) == 0:
+      return None
+   cols = np.flatnonzero(frame[rows[0]:rows[-1] + 1].any(axis=0))
+   return rows[0], rows[-1], cols[0], cols[-1]
+
+
+###################################################
+##       Function: preview_shape                 ##
+## Size of the contour preview of a height x     ##
+## width frame drawn at scale.                   ##
+###################################################
+def preview_shape(height, width, scale):
+   return max(1, int(round(height * scale))), max(1, int(round(width * scale)))
+
+
+###################################################
+##       Function: contour_frame                 ##
+## Finds the contours of one frame of the label  ##
+## volume and turns them into polygons. Takes an ##
+## (index, transform, box, retrieval, scale)     ##
+## task, see contours_to_polygons for transform. ##
+## Only the box (top, bottom, left, right) of    ##
+## the frame, padded by a pixel, is read and     ##
+## contoured; the contours are offset back to    ##
+## frame pixels. If box is None the occupied box ##
+## of the frame is used. Returns the index, the  ##
+## geometry as a mapping and the contours drawn  ##
+## at scale for the preview, or None if scale is ##
+## 0.                                            ##
+###################################################
+def contour_frame(task):
+   with span("contour", frame=task[0]):
+      return find_frame_contours(task)
+
+
+###################################################
+##       Function: find_frame_contours           ##
+## Does the work of contour_frame, which times   ##
+## it when tracing is on.                        ##
+###################################################
+def find_frame_contours(task):
+   import cv2 as cv
+   from shapely.geometry import mapping, MultiPolygon
+   global frame_buffer
+   index, transform, box, retrieval, scale = task
+   height, width = label_volume.shape[1:]
+   if box is None:
+      box = frame_bounds(label_volume[index])
+   contour_image = None
+   if scale > 0:
+      contour_image = np.zeros(preview_shape(height, width, scale), dtype=np.uint8)
+   if box is None or box[1] < box[0] or box[3] < box[2]:
+      return index, mapping(MultiPolygon()), contour_image
+
+   top, bottom, left, right = box
+   top = max(top - 1, 0)
+   left = max(left - 1, 0)
+   bottom = min(bottom + 2, height)
+   right = min(right + 2, width)
+   frame = label_volume[index, top:bottom, left:right]
+   # every label becomes 1, written into the same buffer for each frame
+   if frame_buffer is None or frame_buffer.size < height * width:
+      frame_buffer = np.empty(height * width, dtype=np.uint8)
+   image = frame_buffer[:frame.size].reshape(frame.shape)
+   np.not_equal(frame, 0, out=image.view(bool))
+
+   contours, hierarchy = cv.findContours(image, getattr(cv, RETRIEVAL_MODES[retrieval]), cv.CHAIN_APPROX_SIMPLE, offset=(int(left), int(top)))
+   if scale == 1:
+      cv.drawContours(contour_image, contours, -1, color=(255,255,255), thickness=10)
+   elif scale > 0:
+      scaled = [(contour * scale).astype(np.int32) for contour in contours]
+      cv.drawContours(contour_image, scaled, -1, color=(255,255,255), thickness=max(1, int(round(10 * scale))))
+   if retrieval != 'ccomp':
+      hierarchy = None
+   polygons = contours_to_polygons(contours, transform=transform, hierarchy=hierarchy)
+   return index, mapping(MultiPolygon(polygons)), contour_image
+
+
+###################################################
+##       Function: feature_transform             ##
+## Returns the affine transform that places a    ##
+## frame's polygons on its width x height pixel  ##
+## canvas. Polygons saved in map coordinates use ##
+## the frame's transform from its properties,    ##
+## polygons in pixels use the identity, as the   ##
+## coords property says. Files without it are    ##
+## guessed from whether the polygons fit inside  ##
+## the frame's map extent.                       ##
+###################################################
+def feature_transform(properties, bounds):
+   from affine import Affine
+   # shape files cut field names to 10 characters
+   transform = Affine(*[float(properties.get(key, properties.get(key[:10]))) for key in ('pixel width', 'row rotation', 'upperleftx_coord', 'column rotation', 'pixel height', 'upperlefty_coord')])
+   coords = properties.get('coords')
+   if coords == 'pixel' or transform.is_degenerate:
+      return Affine.identity()
+   if coords == 'map':
+      return transform
+   # files written before the coords field was saved
+   left, top = transform * (0, 0)
+   right, bottom = transform * (properties['width'], properties['height'])
+   min_x, min_y, max_x, max_y = bounds
+   inside = min(left, right) <= min_x and max_x <= max(left, right) and min(top, bottom) <= min_y and max_y <= max(top, bottom)
+   if inside:
+      return transform
+   return Affine.identity()
+
+
+###################################################
+##       Function: render_features               ##
+## Burns the polygons of one frame into a white  ##
+## height x width image in black. Takes a        ##
+## (geometries, properties, width, height) task, ##
+## where properties are the frame's meta data.   ##
+###################################################
+def render_features(task):
+   import shapely
+   from rasterio import features
+   geometries, properties, width, height = task
+   geometries = [geometry for geometry in geometries if not geometry.is_empty]
+   if len(geometries) == 0:
+      return np.full((height, width), 255, dtype=np.uint8)
+   bounds = shapely.total_bounds(geometries)
+   mask = features.rasterize(geometries, out_shape=(height, width), transform=feature_transform(properties, bounds), fill=0, default_value=1, dtype=np.uint8)
+   return (1 - mask) * np.uint8(255)
+
 
 class Contour2Shp:
    ###################################################
@@ -26,98 +235,254 @@ class Contour2Shp:
          image_names.append(file_name)        
       return np.asarray(image_names)
 
+   ###################################################
+   ##       Function: label_paths                   ##
+   ## Finds the outputs of ConnectedComp in         ##
+   ## apply_directory: the label volume name.npy    ##
+   ## and its name_names.npy and name_meta.npy.     ##
+   ## The most recent set is used when there are    ##
+   ## several. The name_components.npy table is     ##
+   ## None if it was not saved.                     ##
+   ###################################################
+   def label_paths(self, apply_directory):
+      found = []
+      for file in Path(apply_directory).glob('*_names.npy'):
+         stem = str(file)[:-len('_names.npy')]
+         if os.path.exists(stem + '.npy') and os.path.exists(stem + '_meta.npy'):
+            found.append((os.path.getmtime(stem + '.npy'), stem))
+      if len(found) == 0:
+         raise FileNotFoundError("No connected components found in " + apply_directory)
+      stem = max(found)[1]
+      components_path = stem + '_components.npy'
+      if not os.path.exists(components_path):
+         components_path = None
+      return stem + '.npy', stem + '_names.npy', stem + '_meta.npy', components_path
+
+   ###################################################
+   ##       Function: retrieve_images               ##
+   ## Loads the names, meta data and component      ##
+   ## table of the frames and returns them with the ##
+   ## path of the label volume, which is opened     ##
+   ## memory mapped by open_label_volume rather     ##
+   ## than read here.                               ##
+   ###################################################
    def retrieve_images(self, apply_directory):
-      dir = Path(apply_directory)
-      meta = []
-      images = []
-      names = []
-      for file in dir.glob('*.npy'):
-         file_name = os.path.basename(file)
-         index = file_name.find('.')
-         check1 = file_name[index - 4:index] 
-         check2 = file_name[index - 5:index]
-         if check1 == "meta":
-            meta = np.load(apply_directory + '/' + file_name, allow_pickle=True)
-         elif check2 == "names":
-            names = np.load(apply_directory + '/' + file_name)
+      images_path, names_path, meta_path, components_path = self.label_paths(apply_directory)
+      print("Labels " + images_path)
+      names = np.load(names_path)
+      meta = np.load(meta_path, allow_pickle=True)
+      components = None
+      if components_path is not None:
+         components = np.load(components_path)
+      return names, images_path, meta, components
+
+   ###################################################
+   ##       Function: component_boxes               ##
+   ## Returns for each frame the box (top, bottom,  ##
+   ## left, right) around the bounding boxes of the ##
+   ## components present in it, from the component  ##
+   ## table. Frames without components get an empty ##
+   ## box.                                          ##
+   ###################################################
+   def component_boxes(self, components, num_frames):
+      boxes = []
+      for index in range(num_frames):
+         present = components[(components['first_frame'] <= index) & (components['last_frame'] >= index)]
+         if len(present) == 0:
+            boxes.append((0, -1, 0, -1))
          else:
-            images = np.load(apply_directory + '/' + file_name)
-            print("Got here " +file_name)
-      return names, images, meta
+            boxes.append((int(present['top'].min()), int(present['bottom'].max()), int(present['left'].min()), int(present['right'].max())))
+      return boxes
 
 
    # creates contours from the connected components and saves them as shape files with meta data
-   def convert_npy_2_shp(self, apply_directory, save_directory):
+   # polygons are in pixel coordinates unless map_coords is True
+   # output_format is shp for one shape file per frame, or gpkg/fgb for every frame in one file
+   # with num_workers above 1 the frames are contoured in a process pool and written in order
+   # each frame is cropped to its components' boxes, or to its occupied box without a component table
+   # retrieval is the cv.findContours mode, tree, external or ccomp (holes kept as interiors)
+   # preview is npy, mp4 or None for a preview of the contours in save_directory, drawn at preview_scale
+   # nothing is done if the save_directory manifest shows the outputs were made from the same label volume with the same settings
+   def convert_npy_2_shp(self, apply_directory, save_directory, map_coords=False, output_format="shp", batch_size=100, num_workers=1, retrieval="tree", preview="npy", preview_scale=1):
+      import fiona
+      from fiona.crs import from_epsg
       if not os.path.exists(save_directory):
          os.makedirs(save_directory) 
-      names, images, meta = self.retrieve_images(apply_directory)
+      names, images_path, meta, components = self.retrieve_images(apply_directory)
+      if preview is None:
+         preview_scale = 0
+      params = {'map_coords': bool(map_coords), 'output_format': output_format, 'retrieval': retrieval, 'preview': preview, 'preview_scale': preview_scale}
+      manifest = Manifest(save_directory, "contours", params)
+      outputs = self.contour_outputs(save_directory, names, output_format, preview)
+      if manifest.is_current(images_path, outputs):
+         print("Contours are up to date: " + save_directory)
+         return
+      boxes = [None] * len(names)
+      if components is not None:
+         boxes = self.component_boxes(components, len(names))
       print("Applying Contours...")
-      # Just for vid purpose only-----------
-      contour_images = []
-      #-------------------------------------
+      info = {
+         'geometry': 'MultiPolygon',
+         'properties' : {'driver':'str', 'dtype':'str', 'nodata':'float', 'width':'int', 'height':'int', 'count':'int', 'crs':'str', 'pixel width':'float', 'row rotation':'float', 'upperleftx_coord':'float', 'column rotation':'float', 'pixel height':'float', 'upperlefty_coord':'float', 'blockxsize':'int', 'blockysize':'int', 'tiled':'bool', 'compress':'str', 'interleave':'str', 'coords':'str'},
+      }
+      layer = self.open_layer(save_directory, output_format, info)
+      records = []
+      height, width = np.load(images_path, mmap_mode='r').shape[1:]
+      preview_frames = self.open_preview(save_directory, preview, len(names), preview_shape(height, width, preview_scale))
       print(len(names))
+      dictionaries = []
+      tasks = []
       for index, name in enumerate(names):
-         ind = name.rfind('.')
-         name = name[:ind]
-         #print(name)
          dictionary = {}
          for indc, data in enumerate(meta[index + 1]):
             dictionary[meta[0][indc]] = data
-         image = []
-         image = np.copy(images[index])
-         image[image > 1] = 1
-         image = image.astype(np.uint8)
-
-         contours, hierarchy = cv.findContours(image, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-         # Just for vid purpose only-----------
-         contour_image = np.zeros_like(image)
-         cv.drawContours(contour_image, contours, -1, color=(255,255,255), thickness=10)
-         contour_images.append(contour_image)
-         #-------------------------------------
-         points = []
-         polygons = []
-         for contour in contours:
-            if len(contour) > 400:
-               contour = np.asarray(contour)
-               num_points = 0
-               points_given = 0
-               for xy in contour:
-                  num_points += 1
-                  if num_points == 15:  # The Number of points that are eliminated
-                     pt = Point(xy[0][0], xy[0][1])
-                     points.append(pt)
-                     points_given += 1
-                     num_points = 0
-               if(points_given < 3):
-                  pass 
-               else:
-                  polygon = Polygon([p.x, p.y] for p in points)
-                  #polygon = polygon.simplify(0.001, False)
-                  polygons.append(polygon)
-               points = []
-         polygon_list = MultiPolygon(polygons) 
-         info = {
-            'geometry': 'MultiPolygon',
-            'properties' : {'driver':'str', 'dtype':'str', 'nodata':'float', 'width':'int', 'height':'int', 'count':'int', 'crs':'str', 'pixel width':'float', 'row rotation':'float', 'upperleftx_coord':'int', 'column rotation':'float', 'pixel height':'float', 'upperlefty_coord':'int', 'blockxsize':'int', 'blockysize':'int', 'tiled':'bool', 'compress':'str', 'interleave':'str'},
-         }
-
-         print("Saving Shape File...")
-         save_path = save_directory + "/" + name + ".shp"
-         shape = fiona.open(save_path, 'w', crs = from_epsg(4326), driver = 'ESRI Shapefile', schema=info)
-         shape.write({
-            'geometry': mapping(polygon_list),
-            'properties' : dictionary,
-         })
-         shape.close()
-      contour_images = np.asarray(contour_images)
-      np.save("Applied_Images/Shape Files/contour.npy", contour_images)
+         # the label volume has the real frame size, whatever the meta data says
+         dictionary['width'] = int(width)
+         dictionary['height'] = int(height)
+         dictionary['coords'] = 'map' if map_coords else 'pixel'
+         dictionaries.append(dictionary)
+         transform = None
+         if map_coords:
+            transform = [float(dictionary[key]) for key in ('pixel width', 'row rotation', 'upperleftx_coord', 'column rotation', 'pixel height', 'upperlefty_coord')]
+         tasks.append((index, transform, boxes[index], retrieval, preview_scale))
+
+      executor = None
+      if num_workers <= 1:
+         open_label_volume(images_path)
+         results = map(contour_frame, tasks)
+      else:
+         executor = ProcessPoolExecutor(max_workers=num_workers, initializer=open_label_volume, initargs=(images_path,))
+         results = bounded_map(executor, contour_frame, tasks, 4 * num_workers)
+
+      for index, geometry, contour_image in results:
+         name = names[index]
+         ind = name.rfind('.')
+         name = name[:ind]
+         dictionary = dictionaries[index]
+         if isinstance(preview_frames, FrameVideoWriter):
+            preview_frames.write(contour_image)
+         elif preview_frames is not None:
+            preview_frames[index] = contour_image
+
+         if layer is None:
+            print("Saving Shape File...")
+            save_path = save_directory + "/" + name + ".shp"
+            with span("write", frame=name) as fields:
+               shape = fiona.open(save_path, 'w', crs = from_epsg(4326), driver = 'ESRI Shapefile', schema=info)
+               shape.write({
+                  'geometry': geometry,
+                  'properties' : dictionary,
+               })
+               shape.close()
+               fields['bytes_written'] = file_size(save_path)
+         else:
+            dictionary['frame'] = index
+            dictionary['name'] = name
+            dictionary['timestamp'] = self.get_timestamp(name)
+            records.append({
+               'geometry': geometry,
+               'properties' : dictionary,
+            })
+            if len(records) >= batch_size:
+               print("Saving {} Contours...".format(len(records)))
+               with span("write", frames=len(records)):
+                  layer.writerecords(records)
+               records = []
+      if executor is not None:
+         executor.shutdown()
+      if layer is not None:
+         if len(records) > 0:
+            print("Saving {} Contours...".format(len(records)))
+            layer.writerecords(records)
+         layer.close()
+      if isinstance(preview_frames, FrameVideoWriter):
+         preview_frames.close()
+      elif preview_frames is not None:
+         preview_frames.flush()
+         del preview_frames
+      manifest.record(images_path, outputs)
+      manifest.save()
+
+   ###################################################
+   ##       Function: contour_outputs               ##
+   ## Paths convert_npy_2_shp writes for the frames ##
+   ## in names: one shape file per frame or one     ##
+   ## layer file, and the preview if there is one.  ##
+   ###################################################
+   def contour_outputs(self, save_directory, names, output_format, preview):
+      if output_format == "shp":
+         outputs = [save_directory + "/" + name[:name.rfind('.')] + ".shp" for name in names]
+      else:
+         outputs = [save_directory + "/contours." + output_format]
+      if preview is not None:
+         outputs.append(save_directory + "/contour." + preview)
+      return outputs
+
+   ###################################################
+   ##       Function: open_preview                  ##
+   ## Opens the contour preview frames are written  ##
+   ## to as they are contoured: a memory mapped     ##
+   ## save_directory/contour.npy for npy, or a      ##
+   ## FrameVideoWriter for save_directory/          ##
+   ## contour.mp4 for mp4. None for no preview.     ##
+   ###################################################
+   def open_preview(self, save_directory, preview, num_frames, shape):
+      if preview == "npy":
+         return np.lib.format.open_memmap(save_directory + "/contour.npy", mode='w+', dtype=np.uint8, shape=(num_frames,) + shape)
+      if preview == "mp4":
+         return FrameVideoWriter(save_directory + "/contour.mp4", shape[1], shape[0])
+      return None
       
+   ###################################################
+   ##       Function: open_layer                    ##
+   ## Opens one layer for the contours of every     ##
+   ## frame, as save_directory/contours.gpkg or     ##
+   ## contours.fgb. Each feature also gets its      ##
+   ## frame index, name and timestamp. Returns None ##
+   ## for shp, which writes one file per frame.     ##
+   ###################################################
+   def open_layer(self, save_directory, output_format, info):
+      import fiona
+      from fiona.crs import from_epsg
+      drivers = {'gpkg': 'GPKG', 'fgb': 'FlatGeobuf'}
+      if output_format == "shp":
+         return None
+      if output_format not in drivers:
+         raise ValueError("Unknown output format: " + str(output_format))
+      schema = {'geometry': info['geometry'], 'properties': dict(info['properties'])}
+      schema['properties']['frame'] = 'int'
+      schema['properties']['name'] = 'str'
+      schema['properties']['timestamp'] = 'str'
+      save_path = save_directory + "/contours." + output_format
+      if os.path.exists(save_path):
+         os.remove(save_path)
+      options = {}
+      if output_format == "fgb":
+         # Frames without a fire have empty geometries, which the spatial index cannot hold
+         options['SPATIAL_INDEX'] = 'NO'
+      return fiona.open(save_path, 'w', crs = from_epsg(4326), driver = drivers[output_format], schema=schema, layer='contours', **options)
+
+   ###################################################
+   ##       Function: get_timestamp                 ##
+   ## Parses the timestamp from a frame name, e.g.  ##
+   ## 20160628T184704Z from                         ##
+   ## AZPHD-000615_20160628T184704Z_00000.          ##
+   ###################################################
+   def get_timestamp(self, name):
+      match = re.search(r'\d{8}T\d{6}Z', name)
+      if match is None:
+         return ''
+      return match.group(0)
+
    ##---------------For Viewing Purposes Only from here on----------------------------
    ###################################################
    ##       Function: view_shape_files              ##
    ## Takes in multiple shape files to view.        ##
    ###################################################
    def view_shape_files(self, file):
+      import fiona
+      import geopandas as gpd
+      import matplotlib.pyplot as plt
       shape = gpd.read_file(file + ".shp")
       width = 0
       height = 0
@@ -128,102 +493,141 @@ class Contour2Shp:
       plt.axis([0, width, height, 0])
       plt.show()
 
+   ###################################################
+   ##       Function: create_contour_vid            ##
+   ## Makes save_path.mp4 from a contour preview    ##
+   ## npy file, dark contours on white. Frames are  ##
+   ## read from a memory map and written to the     ##
+   ## video one at a time.                          ##
+   ###################################################
    def create_contour_vid(self, path, save_path):
       print(save_path)
       print(path)
-      ccarray = np.load(path)
-      images = []
-      fig = plt.figure()
-      for image in ccarray:
-         plt.title("Contours")
-         images.append([plt.imshow(image, cmap="Greys")])#, cmap='nipy_spectral')])
-      images = np.asarray(images)
-      print("Creating Animation")
-      ani = animation.ArtistAnimation(fig, images, interval=50, blit=True,
-                                    repeat_delay=1000)
+      ccarray = np.load(path, mmap_mode='r')
       print("Saving Animation")
+      with FrameVideoWriter(save_path + ".mp4", ccarray.shape[2], ccarray.shape[1], fps=20) as video:
+         for image in ccarray:
+            video.write(255 - image)
 
-      save_name = save_path + ".mp4"
-
-      ani.save(save_name)
+   ###################################################
+   ##       Function: frame_features                ##
+   ## Yields the (geometries, properties) of each   ##
+   ## frame in order, from the shape files in       ##
+   ## apply_path sorted by name, or from the frame  ##
+   ## field of a contours.gpkg or contours.fgb file ##
+   ## given as apply_path. A frame without a fire,  ##
+   ## saved as a null geometry, yields no polygons. ##
+   ###################################################
+   def frame_features(self, apply_path):
+      import fiona
+      from shapely.geometry import shape
+      if os.path.isfile(apply_path):
+         frame = None
+         geometries = []
+         properties = None
+         for feature in fiona.open(apply_path):
+            if properties is not None and feature['properties']['frame'] != frame:
+               yield geometries, properties
+               geometries = []
+            frame = feature['properties']['frame']
+            properties = dict(feature['properties'])
+            if feature['geometry'] is not None:
+               geometries.append(shape(feature['geometry']))
+         if properties is not None:
+            yield geometries, properties
+      else:
+         for file_name in sorted(str(file) for file in Path(apply_path).glob('*.shp')):
+            geometries = []
+            properties = None
+            for feature in fiona.open(file_name):
+               properties = dict(feature['properties'])
+               if feature['geometry'] is not None:
+                  geometries.append(shape(feature['geometry']))
+            if properties is not None:
+               yield geometries, properties
 
-   def create_vid(self, apply_path, save_path):
-      if not os.path.exists("temp_directory"):
-         os.makedirs("temp_directory")
-      dir = Path(apply_path)
-      images = []
-      width = 0
-      height = 0
-      
-      interval = 0
+   ###################################################
+   ##       Function: create_vid                    ##
+   ## Makes save_path.mp4 from the contours in      ##
+   ## apply_path, a directory of shape files or a   ##
+   ## GeoPackage/FlatGeobuf file, one frame each.   ##
+   ## The polygons are burned into a canvas the     ##
+   ## size of the width and height properties by    ##
+   ## render_features in num_workers processes,     ##
+   ## with only a few frames held at a time, and    ##
+   ## written to the video as they come back.       ##
+   ###################################################
+   def create_vid(self, apply_path, save_path, num_workers=1):
+      frames = self.frame_features(apply_path)
+      first = next(frames, None)
+      if first is None:
+         print("No contours found in " + apply_path)
+         return
+      width = int(first[1]['width'])
+      height = int(first[1]['height'])
+      tasks = ((geometries, properties, width, height) for geometries, properties in chain([first], frames))
 
-      for file in dir.glob('*.shp'):
-         index = os.path.basename(file).rfind('.')
-         if not os.path.exists("temp_directory/" + os.path.basename(file)[:index] + ".png"):
-            file_name = os.path.dirname(file) + "/" + os.path.basename(file)
-            shape = gpd.read_file(file_name)
-            # shape = shp.Reader(file_name)
-            # if interval == 0:
-            #    for dictionary in fiona.open(file_name):
-            #       height = dictionary['properties']['height']
-            #       width = dictionary['properties']['width']
-            #    interval += 1
-            # #polygons = []
-            # for sh in shape.shapeRecords():
-            #    x = [i[0] for i in sh.shape.points[:]]
-            #    y = [i[1] for i in sh.shape.points[:]]
-            #    #polygon, = plt.plot(x, y, 'o', markersize=30)
-            #    #polygons.append(polygon)
-            #    plt.title("Contours")
-            #    plt.axis([0, width, height, 0])
-            #    plt.plot(x, y, 'o', markersize=1)
-                
-            
-            # shape.plot()
-            # plt.show()
-
-
-            plt.savefig("temp_directory/" + os.path.basename(file)[:index] + ".png", bbox_inches='tight')
-         plt.close('all')
-      fig = plt.figure()
-      dir = Path("temp_directory")
-      images = []
-      for file in dir.glob('*.png'):
-         file_name = os.path.dirname(file) + "/" + os.path.basename(file)
-         image = cv.imread(file_name)
-         images.append([plt.imshow(image)])#, cmap='nipy_spectral')])
-           
       print("Creating Animation")
-
-      ani = animation.ArtistAnimation(fig, images, interval=100, blit=True,
-                                    repeat_delay=1000)
+      executor = None
+      if num_workers <= 1:
+         results = map(render_features, tasks)
+      else:
+         executor = ProcessPoolExecutor(max_workers=num_workers)
+         results = bounded_map(executor, render_features, tasks, 2 * num_workers)
+      with FrameVideoWriter(save_path + ".mp4", width, height, fps=10) as video:
+         for image in results:
+            video.write(image)
+      if executor is not None:
+         executor.shutdown()
       print("Saving Animation")
-      ani.save(save_path + ".mp4")
-      for file in dir.glob('*.png'):
-         file_name = os.path.dirname(file) + "/" + os.path.basename(file)
-         os.remove(file_name)
-      os.rmdir("temp_directory")
 
          
 
 def main():
-   plt.rcParams['animation.ffmpeg_path'] = '/usr/bin/ffmpeg' # I need this for some reason?? Take out if it causes issues.
    cs = Contour2Shp()
    print("Notice: You can run all processes at once using Main.py. If you run scripts individually please note that this script is intended to run after ConnectedComp.py. If it is executed after a different script it will not work.")
    if len(sys.argv) < 2:
       print("Please enter the directory of the images you would like to compress and the new directory for the compressed images.")
-   elif sys.argv[1].lower() == "shp" and len(sys.argv) == 4:
-      cs.convert_npy_2_shp(sys.argv[2], sys.argv[3])
-   elif sys.argv[1].lower() == "shp" and len(sys.argv) != 4:
+   elif sys.argv[1].lower() == "shp" and len(sys.argv) >= 4 and all(arg.lower() in ("map", "shp", "gpkg", "fgb", "mp4", "nopreview") or arg.lower() in RETRIEVAL_MODES or arg.replace('.', '', 1).isdigit() for arg in sys.argv[4:]):
+      options = [arg.lower() for arg in sys.argv[4:]]
+      output_format = "shp"
+      num_workers = 1
+      retrieval = "tree"
+      preview = "npy"
+      preview_scale = 1
+      for option in options:
+         if option.isdigit():
+            num_workers = int(option)
+         elif '.' in option:
+            preview_scale = float(option)
+         elif option in RETRIEVAL_MODES:
+            retrieval = option
+         elif option == "mp4":
+            preview = "mp4"
+         elif option == "nopreview":
+            preview = None
+         elif option != "map":
+            output_format = option
+      cs.convert_npy_2_shp(sys.argv[2], sys.argv[3], "map" in options, output_format, num_workers=num_workers, retrieval=retrieval, preview=preview, preview_scale=preview_scale)
+   elif sys.argv[1].lower() == "shp":
       print("To convert images into contour shape files please enter: shp image_directory_to_apply save_directory")
+      print("To save the contours in map coordinates instead of pixels please enter: shp image_directory_to_apply save_directory map")
+      print("To save every frame in one GeoPackage or FlatGeobuf file add gpkg or fgb, e.g.: shp image_directory_to_apply save_directory gpkg")
+      print("To contour frames in several processes add the number of workers, e.g.: shp image_directory_to_apply save_directory gpkg 8")
+      print("To choose how contours are found add tree (default), external or ccomp (holes kept in the polygons), e.g.: shp image_directory_to_apply save_directory ccomp")
+      print("The contours are also saved to save_directory/contour.npy. Add mp4 to save them as a video instead, nopreview to skip them, or a scale such as 0.25 to save them smaller.")
    elif sys.argv[1].lower() == "view" and len(sys.argv) == 3:
       cs.view_shape_files(sys.argv[2])
    elif sys.argv[1].lower() == "view" and len(sys.argv) != 3:
       print("To view an image please enter: view image_directory")
-   elif sys.argv[1].lower() == "vid" and len(sys.argv) == 4:
-      cs.create_vid(sys.argv[2], sys.argv[3])
-   elif sys.argv[1].lower() == "vid" and len(sys.argv) != 4:
-      print("Warning: Currently does not work. To create a video please enter: vid apply_directory save_directory")
+   elif sys.argv[1].lower() == "vid" and len(sys.argv) in (4, 5):
+      num_workers = 1
+      if len(sys.argv) == 5:
+         num_workers = int(sys.argv[4])
+      cs.create_vid(sys.argv[2], sys.argv[3], num_workers)
+   elif sys.argv[1].lower() == "vid":
+      print("To create a video please enter: vid apply_directory save_directory [number_workers]")
+      print("apply_directory can also be a contours.gpkg or contours.fgb file.")
    elif sys.argv[1].lower() == "vidcont" and len(sys.argv) == 4:
       cs.create_contour_vid(sys.argv[2], sys.argv[3])
    elif sys.argv[1].lower() == "vidcont" and len(sys.argv) != 4:
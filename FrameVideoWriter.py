@@ -0,0 +1,71 @@
+import numpy as np
+import shutil
+import subprocess
+
+'''----------------------------------------
+|   Class: FrameVideoWriter                |
+|   Writes grayscale uint8 frames to a     |
+|   video one frame at a time, so no frame |
+|   is kept after it is written.           |
+|------------------------------------------|
+'''
+class FrameVideoWriter:
+   ###################################################
+   ##       Function: __init__                      ##
+   ## Starts an ffmpeg process reading raw gray     ##
+   ## frames from a pipe and encoding them to       ##
+   ## save_path. If ffmpeg is not installed         ##
+   ## OpenCV's VideoWriter is used instead.         ##
+   ###################################################
+   def __init__(self, save_path, width, height, fps=20, ffmpeg_path=None):
+      self.save_path = save_path
+      self.width = int(width)
+      self.height = int(height)
+      self.process = None
+      self.writer = None
+      if ffmpeg_path is None:
+         ffmpeg_path = shutil.which("ffmpeg")
+      if ffmpeg_path is not None:
+         command = [ffmpeg_path, '-y', '-loglevel', 'error',
+                    '-f', 'rawvideo', '-pix_fmt', 'gray', '-s', "{}x{}".format(self.width, self.height), '-r', str(fps), '-i', '-',
+                    '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', save_path]
+         self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+      else:
+         import cv2 as cv
+         self.writer = cv.VideoWriter(save_path, cv.VideoWriter_fourcc(*'mp4v'), fps, (self.width, self.height), isColor=False)
+         if not self.writer.isOpened():
+            raise IOError("Could not open a video writer for " + save_path)
+
+   ###################################################
+   ##       Function: write                         ##
+   ## Writes one height x width uint8 frame.        ##
+   ###################################################
+   def write(self, frame):
+      frame = np.ascontiguousarray(frame, dtype=np.uint8)
+      if frame.shape != (self.height, self.width):
+         raise ValueError("Frame is {} but the video is {}".format(frame.shape, (self.height, self.width)))
+      if self.process is not None:
+         self.process.stdin.write(memoryview(frame).cast('B'))
+      else:
+         self.writer.write(frame)
+
+   ###################################################
+   ##       Function: close                         ##
+   ## Finishes the video. Raises an error if ffmpeg ##
+   ## failed to encode it.                          ##
+   ###################################################
+   def close(self):
+      if self.process is not None:
+         self.process.stdin.close()
+         if self.process.wait() != 0:
+            raise IOError("ffmpeg could not write " + self.save_path)
+         self.process = None
+      if self.writer is not None:
+         self.writer.release()
+         self.writer = None
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      self.close()
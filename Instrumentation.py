@@ -0,0 +1,259 @@
+import os
+import sys
+import json
+import time
+import threading
+import resource
+from glob import glob
+from contextlib import contextmanager
+
+'''----------------------------------------
+|   Class: Instrumentation                 |
+|   Records how long each stage and frame  |
+|   takes, in every process. Off unless    |
+|   FIRE_TRACE_DIR is set, which worker    |
+|   processes inherit.                     |
+|------------------------------------------|
+'''
+
+TRACE_ENV = "FIRE_TRACE_DIR"
+trace_directory = os.environ.get(TRACE_ENV) or None
+trace_file = None
+trace_pid = None
+trace_lock = threading.Lock()
+
+
+###################################################
+##       Function: enable                        ##
+## Turns tracing on for this process and every   ##
+## process it starts afterwards. Each process    ##
+## writes its own directory/trace.<pid>.jsonl.   ##
+###################################################
+def enable(directory):
+   global trace_directory
+   directory = os.path.abspath(directory)
+   if not os.path.exists(directory):
+      os.makedirs(directory)
+   os.environ[TRACE_ENV] = directory
+   trace_directory = directory
+
+
+###################################################
+##       Function: disable                       ##
+## Turns tracing off and closes the trace file.  ##
+###################################################
+def disable():
+   global trace_directory, trace_file
+   os.environ.pop(TRACE_ENV, None)
+   trace_directory = None
+   if trace_file is not None:
+      trace_file.close()
+      trace_file = None
+
+
+###################################################
+##       Function: enabled                       ##
+## True if tracing is on.                        ##
+###################################################
+def enabled():
+   return trace_directory is not None
+
+
+###################################################
+##       Function: emit                          ##
+## Appends one event to this process's trace     ##
+## file. The file is reopened after a fork so a  ##
+## child never writes into its parent's file.    ##
+###################################################
+def emit(event):
+   global trace_file, trace_pid
+   pid = os.getpid()
+   with trace_lock:
+      if trace_file is None or trace_pid != pid:
+         trace_file = open(os.path.join(trace_directory, "trace.{}.jsonl".format(pid)), "a", buffering=1)
+         trace_pid = pid
+      trace_file.write(json.dumps(event, default=str) + "\n")
+
+
+###################################################
+##       Function: peak_memory_mb                ##
+## Peak resident memory of this process in MB.   ##
+###################################################
+def peak_memory_mb():
+   scale = 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0
+   return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+###################################################
+##       Function: span                          ##
+## Times the code in a with block as one event   ##
+## named name, e.g. span("kmeans", frame=name).  ##
+## Extra fields are saved with it; more can be   ##
+## added inside the block through the yielded    ##
+## dictionary (e.g. bytes_written). Does nothing ##
+## but yield when tracing is off.                ##
+###################################################
+@contextmanager
+def span(name, **fields):
+   if trace_directory is None:
+      yield fields
+      return
+   start = time.time()
+   cpu = time.process_time()
+   try:
+      yield fields
+   finally:
+      end = time.time()
+      event = {'name': name, 'start': start, 'seconds': end - start, 'cpu_seconds': time.process_time() - cpu, 'pid': os.getpid(), 'tid': threading.get_ident(), 'peak_memory_mb': peak_memory_mb()}
+      event.update(fields)
+      emit(event)
+
+
+###################################################
+##       Function: record                        ##
+## Saves an event of seconds that has just       ##
+## ended, for code already timed another way.    ##
+###################################################
+def record(name, seconds, **fields):
+   if trace_directory is None:
+      return
+   event = {'name': name, 'start': time.time() - seconds, 'seconds': seconds, 'pid': os.getpid(), 'tid': threading.get_ident(), 'peak_memory_mb': peak_memory_mb()}
+   event.update(fields)
+   emit(event)
+
+
+###################################################
+##       Function: file_size                     ##
+## Size of path in bytes, or 0 if it is missing. ##
+## Used for the bytes_read and bytes_written     ##
+## fields of spans.                              ##
+###################################################
+def file_size(path):
+   try:
+      return os.path.getsize(path)
+   except OSError:
+      return 0
+
+
+###################################################
+##       Function: read_events                   ##
+## Loads the events of every process traced into ##
+## directory, ordered by start time.             ##
+###################################################
+def read_events(directory):
+   events = []
+   for path in glob(os.path.join(directory, "trace.*.jsonl")):
+      with open(path, "r") as events_file:
+         for line in events_file:
+            line = line.strip()
+            if line:
+               events.append(json.loads(line))
+   events.sort(key=lambda event: event['start'])
+   return events
+
+
+###################################################
+##       Function: export_jsonl                  ##
+## Merges the per-process trace files of         ##
+## directory into one JSON lines file.           ##
+###################################################
+def export_jsonl(directory, save_path):
+   with open(save_path, "w") as save_file:
+      for event in read_events(directory):
+         save_file.write(json.dumps(event) + "\n")
+
+
+###################################################
+##       Function: export_chrome_trace           ##
+## Writes the events of directory in the Chrome  ##
+## trace format, for chrome://tracing or         ##
+## Perfetto. Each span is a complete event on    ##
+## its process and thread; peak memory is also   ##
+## drawn as a counter per process.               ##
+###################################################
+def export_chrome_trace(directory, save_path):
+   events = read_events(directory)
+   origin = events[0]['start'] if len(events) > 0 else 0
+   trace_events = []
+   for event in events:
+      args = {key: value for key, value in event.items() if key not in ('name', 'start', 'seconds', 'pid', 'tid')}
+      timestamp = (event['start'] - origin) * 1e6
+      trace_events.append({'name': event['name'], 'ph': 'X', 'ts': timestamp, 'dur': event['seconds'] * 1e6, 'pid': event['pid'], 'tid': event['tid'], 'args': args})
+      trace_events.append({'name': 'peak_memory_mb', 'ph': 'C', 'ts': timestamp + event['seconds'] * 1e6, 'pid': event['pid'], 'args': {'MB': event['peak_memory_mb']}})
+   with open(save_path, "w") as save_file:
+      json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, save_file)
+
+
+###################################################
+##       Function: summary                       ##
+## Totals the events of directory by name: count ##
+## and total, mean and longest time, with the    ##
+## frame that took longest, plus bytes read and  ##
+## written. Worker utilisation is the time each  ##
+## process spent in spans, excluding spans       ##
+## nested in others, over the traced wall time.  ##
+###################################################
+def summary(directory):
+   events = read_events(directory)
+   if len(events) == 0:
+      return {'spans': {}, 'utilisation': {}}
+   spans = {}
+   for event in events:
+      total = spans.setdefault(event['name'], {'count': 0, 'seconds': 0.0, 'longest_seconds': 0.0, 'longest_frame': None, 'bytes_read': 0, 'bytes_written': 0, 'peak_memory_mb': 0.0})
+      total['count'] += 1
+      total['seconds'] += event['seconds']
+      if event['seconds'] > total['longest_seconds']:
+         total['longest_seconds'] = event['seconds']
+         total['longest_frame'] = event.get('frame')
+      total['bytes_read'] += event.get('bytes_read', 0)
+      total['bytes_written'] += event.get('bytes_written', 0)
+      total['peak_memory_mb'] = max(total['peak_memory_mb'], event['peak_memory_mb'])
+   for total in spans.values():
+      total['mean_seconds'] = total['seconds'] / total['count']
+
+   wall = max(event['start'] + event['seconds'] for event in events) - events[0]['start']
+   busy = {}
+   for pid in set(event['pid'] for event in events):
+      intervals = sorted((event['start'], event['start'] + event['seconds']) for event in events if event['pid'] == pid)
+      covered = 0.0
+      current_start, current_end = intervals[0]
+      for start, end in intervals[1:]:
+         if start > current_end:
+            covered += current_end - current_start
+            current_start, current_end = start, end
+         else:
+            current_end = max(current_end, end)
+      covered += current_end - current_start
+      busy[str(pid)] = covered / wall if wall > 0 else 0.0
+   return {'spans': spans, 'utilisation': busy, 'wall_seconds': wall}
+
+
+###################################################
+##       Function: print_summary                 ##
+## Prints summary(directory) as a table.         ##
+###################################################
+def print_summary(directory):
+   totals = summary(directory)
+   print("{:24s}{:>8s}{:>12s}{:>12s}{:>12s}  {}".format("span", "count", "total s", "mean s", "longest s", "longest frame"))
+   for name, total in sorted(totals['spans'].items(), key=lambda item: -item[1]['seconds']):
+      print("{:24s}{:>8d}{:>12.3f}{:>12.3f}{:>12.3f}  {}".format(name, total['count'], total['seconds'], total['mean_seconds'], total['longest_seconds'], total['longest_frame']))
+   for pid, utilisation in sorted(totals['utilisation'].items()):
+      print("process {} busy {:.0%} of the traced time".format(pid, utilisation))
+   return totals
+
+
+def main():
+   if len(sys.argv) == 3 and sys.argv[1].lower() == "summary":
+      print_summary(sys.argv[2])
+   elif len(sys.argv) == 4 and sys.argv[1].lower() == "chrome":
+      export_chrome_trace(sys.argv[2], sys.argv[3])
+   elif len(sys.argv) == 4 and sys.argv[1].lower() == "jsonl":
+      export_jsonl(sys.argv[2], sys.argv[3])
+   else:
+      print("Tracing is turned on by setting " + TRACE_ENV + " to a directory, or with the trace option of Main.py.")
+      print("To summarise a trace please enter: summary trace_directory")
+      print("To export a trace for chrome://tracing or Perfetto please enter: chrome trace_directory save_path.json")
+      print("To merge a trace into one JSON lines file please enter: jsonl trace_directory save_path.jsonl")
+
+if __name__ == "__main__":
+   main()
@@ -3,12 +3,231 @@ import os
 import sys
 from math import sqrt
 from pathlib import Path
-import rasterio as rst
-import matplotlib.pyplot as plt
-import cv2 as cv
-from scipy.ndimage import gaussian_filter
+from concurrent.futures import ThreadPoolExecutor
+from Manifest import Manifest
+from OutputProfile import DEFAULT_PROFILE, write_raster
+from Instrumentation import span, file_size
+
+
+###################################################
+##       Function: histogram_kmeans              ##
+## Exact k-means for an integer image, run on    ##
+## its histogram instead of on every pixel. Each ##
+## Lloyd iteration costs O(number of bins), and  ##
+## the starting centers are the histogram        ##
+## quantiles, so the result is deterministic.    ##
+## Starting centers can be given instead, e.g.   ##
+## the centers of the previous frame, and the    ##
+## image's histogram if it was already counted.  ##
+## Returns the centers, for every bin the index  ##
+## of the cluster it belongs to, and the         ##
+## histogram.                                    ##
+###################################################
+def histogram_kmeans(image, k=5, max_iter=100, center=None, hist=None):
+   if hist is None:
+      # unsigned images cannot be negative, so only signed ones are scanned
+      if not np.issubdtype(image.dtype, np.integer) or (np.issubdtype(image.dtype, np.signedinteger) and image.min() < 0):
+         raise ValueError("The histogram k-means engine needs a non-negative integer image, got " + str(image.dtype))
+      hist = np.bincount(image.ravel()).astype(np.float64)
+   values = np.arange(len(hist), dtype=np.float64)
+
+   if center is None:
+      cumulative = np.cumsum(hist) / hist.sum()
+      center = values[np.searchsorted(cumulative, (np.arange(k) + 0.5) / k)]
+   center = np.asarray(center, dtype=np.float64)
+   for iteration in range(max_iter):
+      assign = np.argmin(np.abs(values[:, None] - center[None, :]), axis=1)
+      counts = np.bincount(assign, weights=hist, minlength=k)
+      sums = np.bincount(assign, weights=hist * values, minlength=k)
+      new_center = np.copy(center)
+      new_center[counts > 0] = sums[counts > 0] / counts[counts > 0]
+
+      # Move an empty cluster to the value that is furthest from its center
+      for empty in np.flatnonzero(counts == 0):
+         error = hist * (values - new_center[assign]) ** 2
+         if error.max() == 0:
+            break
+         new_center[empty] = values[np.argmax(error)]
+         assign[np.argmax(error)] = empty
+
+      if np.array_equal(new_center, center):
+         break
+      center = new_center
+   assign = np.argmin(np.abs(values[:, None] - center[None, :]), axis=1)
+   return center, assign, hist
+
+
+###################################################
+##       Function: blur_band                     ##
+## Blurs a band with a gaussian of the given     ##
+## sigma. engine selects how:                    ##
+##   scipy     - scipy's gaussian_filter         ##
+##   opencv    - opencv_blur, matches scipy to   ##
+##               within one intensity level      ##
+##   box       - three iterated box filters      ##
+##   decimated - gaussian at 1/factor of the     ##
+##               resolution, then upsampled      ##
+## Every engine except decimated can run over    ##
+## num_threads strips of rows at once. The       ##
+## result has the same dtype as the band.        ##
+###################################################
+def blur_band(band, sigma=5, engine="scipy", num_threads=1, factor=4):
+   radius = int(4.0 * sigma + 0.5)
+   if engine == "scipy":
+      from scipy.ndimage import gaussian_filter
+      blur = lambda strip: gaussian_filter(strip, sigma=sigma)
+   elif engine == "opencv":
+      blur = lambda strip: opencv_blur(strip, sigma, radius)
+   elif engine == "box":
+      widths = box_widths(sigma, 3)
+      radius = sum(width // 2 for width in widths)
+      blur = lambda strip: box_blur(strip, widths)
+   elif engine == "decimated":
+      return decimated_blur(band, sigma, factor)
+   else:
+      raise ValueError("Unknown blur engine: " + str(engine))
+   if num_threads <= 1:
+      return blur(band)
+   return blur_strips(band, blur, radius, num_threads)
+
+
+###################################################
+##       Function: blur_strips                   ##
+## Runs blur over horizontal strips of the band  ##
+## in a thread pool. Each strip is read with     ##
+## halo extra rows on both sides, so rows away   ##
+## from the image edge come out the same as      ##
+## blurring the whole band at once.              ##
+###################################################
+def blur_strips(band, blur, halo, num_threads):
+   height = band.shape[0]
+   bounds = np.linspace(0, height, num_threads + 1).astype(int)
+   blurred = np.empty_like(band)
+
+   def blur_strip(start, stop):
+      top = max(start - halo, 0)
+      bottom = min(stop + halo, height)
+      blurred[start:stop] = blur(band[top:bottom])[start - top:stop - top]
+
+   with ThreadPoolExecutor(max_workers=num_threads) as executor:
+      list(executor.map(blur_strip, bounds[:-1], bounds[1:]))
+   return blurred
+
+
+###################################################
+##       Function: opencv_blur                   ##
+## Separable gaussian using OpenCV, with the     ##
+## same kernel radius and reflected border as    ##
+## scipy. For integer bands each pass is         ##
+## truncated back to the band's dtype, the way   ##
+## gaussian_filter does, so the two agree on     ##
+## almost every pixel.                           ##
+###################################################
+def opencv_blur(band, sigma, radius):
+   import cv2 as cv
+   kernel = cv.getGaussianKernel(2 * radius + 1, sigma, cv.CV_32F)
+   identity = np.ones((1, 1), np.float32)
+   blurred = np.float32(band)
+   for kernel_x, kernel_y in ((identity, kernel), (kernel, identity)):
+      blurred = cv.sepFilter2D(blurred, -1, kernel_x, kernel_y, borderType=cv.BORDER_REFLECT)
+      if np.issubdtype(band.dtype, np.integer):
+         blurred = np.floor(blurred).astype(band.dtype).astype(np.float32)
+   return blurred.astype(band.dtype)
+
+
+###################################################
+##       Function: box_widths                    ##
+## Odd box filter widths whose n passes together ##
+## have the variance of a gaussian of sigma.     ##
+###################################################
+def box_widths(sigma, n=3):
+   ideal = np.sqrt(12.0 * sigma * sigma / n + 1)
+   lower = int(np.floor(ideal))
+   if lower % 2 == 0:
+      lower -= 1
+   upper = lower + 2
+   num_lower = int(round((12.0 * sigma * sigma - n * lower * lower - 4 * n * lower - 3 * n) / (-4.0 * lower - 4)))
+   return [lower if index < num_lower else upper for index in range(n)]
+
+
+###################################################
+##       Function: box_blur                      ##
+## Applies one box filter per width, in float32  ##
+## so integer bands are only truncated once, at  ##
+## the end.                                      ##
+###################################################
+def box_blur(band, widths):
+   import cv2 as cv
+   blurred = np.float32(band)
+   for width in widths:
+      blurred = cv.blur(blurred, (width, width), borderType=cv.BORDER_REFLECT)
+   if np.issubdtype(band.dtype, np.integer):
+      blurred = np.floor(blurred)
+   return blurred.astype(band.dtype)
+
+
+###################################################
+##       Function: decimated_blur                ##
+## Shrinks the band by factor, blurs it with     ##
+## sigma / factor and resizes it back up.        ##
+###################################################
+def decimated_blur(band, sigma, factor=4):
+   import cv2 as cv
+   height, width = band.shape
+   small = cv.resize(band, (max(width // factor, 1), max(height // factor, 1)), interpolation=cv.INTER_AREA)
+   small_sigma = sigma / float(factor)
+   ksize = 2 * int(4.0 * small_sigma + 0.5) + 1
+   small = cv.GaussianBlur(small, (ksize, ksize), small_sigma, borderType=cv.BORDER_REFLECT)
+   return cv.resize(small, (width, height), interpolation=cv.INTER_LINEAR)
+
+
+###################################################
+##       Function: blur_accuracy                 ##
+## Compares a blur engine against scipy's        ##
+## gaussian_filter on the same band. Returns the ##
+## max and mean absolute difference, and the     ##
+## fraction of pixels that differ.               ##
+###################################################
+def blur_accuracy(band, sigma=5, engine="opencv", num_threads=1, factor=4):
+   from scipy.ndimage import gaussian_filter
+   expected = gaussian_filter(band, sigma=sigma).astype(np.float64)
+   blurred = blur_band(band, sigma, engine, num_threads, factor).astype(np.float64)
+   difference = np.abs(blurred - expected)
+   return {
+      'max_abs_error': float(difference.max()),
+      'mean_abs_error': float(difference.mean()),
+      'fraction_different': float(np.mean(difference > 0))
+   }
+
 
 class KMeansConverter:
+   ###################################################
+   ## engine selects how k-means is computed:       ##
+   ##   opencv    - cv.kmeans on every pixel        ##
+   ##   histogram - histogram_kmeans, exact and     ##
+   ##               deterministic for uint8 images  ##
+   ## With sequence set, each frame starts from the ##
+   ## previous frame's centers with a single        ##
+   ## attempt run to convergence. A frame is only   ##
+   ## restarted from scratch if a center moves by   ##
+   ## more than drift_threshold intensity levels.   ##
+   ## blur selects the blur_band engine used before ##
+   ## clustering, over num_threads strips.          ##
+   ## output is the OutputProfile saved images are  ##
+   ## written with, compressed by GDAL on           ##
+   ## write_threads threads.                        ##
+   ###################################################
+   def __init__(self, engine="opencv", sequence=False, drift_threshold=10.0, blur="scipy", num_threads=1, output=DEFAULT_PROFILE, write_threads=None):
+      self.engine = engine
+      self.output = output
+      self.write_threads = write_threads
+      self.blur = blur
+      self.num_threads = num_threads
+      self.sequence = sequence
+      self.drift_threshold = drift_threshold
+      self.previous_centers = None
+      self.restarts = 0
+      self.manifest = None
 
    ###################################################
    ##       Function: image_locations               ##
@@ -38,15 +257,81 @@ class KMeansConverter:
    ##       Function: apply_KMeans                  ##
    ## Applies 5 cluster k-means to images. If you   ##
    ## would like to you can add max_accumulate to   ##
-   ## k-means.                                      ##
+   ## k-means. When saving, an image already in the ##
+   ## save_directory manifest with the same input   ##
+   ## and settings is read back instead of redone,  ##
+   ## unless max_accumulate or sequence carry state ##
+   ## from one image to the next. Call              ##
+   ## save_manifest after the last image.           ##
    ###################################################
    previous_image = []
    iteration = 0
    def apply_KMeans(self, image_path, save_directory, apply_max_accumulate = False, save = True):
-      raster = rst.open(image_path)
-      band = raster.read(1)
-      meta = raster.profile
+      import rasterio as rst
+      save_path = save_directory + "/" + self.get_file_name(image_path)
+      if(save):
+         manifest = self.stage_manifest(save_directory, apply_max_accumulate)
+         if not (apply_max_accumulate or self.sequence) and manifest.is_current(image_path, save_path):
+            with rst.open(save_path) as raster:
+               return raster.read(1)
+      frame = self.get_file_name(image_path)
+      with span("read", frame=frame, bytes_read=file_size(image_path)):
+         raster = rst.open(image_path)
+         band = raster.read(1)
+         meta = raster.profile
 
+      with span("cluster", frame=frame):
+         k_applied_image = self.cluster_band(band, apply_max_accumulate)
+
+      meta['dtype'] = 'uint8'
+      if(save):
+         if not os.path.exists(save_directory):
+            os.makedirs(save_directory)
+         with span("write", frame=frame, output=self.output) as fields:
+            write_raster(save_path, k_applied_image, meta, self.output, self.write_threads, categorical=True)
+            fields['bytes_written'] = file_size(save_path)
+         manifest.record(image_path, save_path)
+      return k_applied_image
+
+   ###################################################
+   ##       Function: stage_manifest                ##
+   ## Returns the manifest of save_directory for    ##
+   ## the current k-means settings, reusing it      ##
+   ## while they stay the same.                     ##
+   ###################################################
+   def stage_manifest(self, save_directory, apply_max_accumulate = False):
+      params = {
+         'engine': self.engine,
+         'blur': self.blur,
+         'k': 5,
+         'sigma': 5,
+         'max_accumulate': bool(apply_max_accumulate),
+         'sequence': self.sequence,
+         'drift_threshold': self.drift_threshold,
+         'output': self.output
+      }
+      if self.manifest is None or self.manifest.path != save_directory + "/manifest.json" or self.manifest.params != params:
+         self.save_manifest()
+         self.manifest = Manifest(save_directory, "kmeans", params)
+      return self.manifest
+
+   ###################################################
+   ##       Function: save_manifest                 ##
+   ## Writes out the manifest of the images saved   ##
+   ## by apply_KMeans.                              ##
+   ###################################################
+   def save_manifest(self):
+      if self.manifest is not None:
+         self.manifest.save()
+
+
+   ###################################################
+   ##       Function: cluster_band                  ##
+   ## Applies 5 cluster k-means to a single band    ##
+   ## and returns it with the brightest cluster set ##
+   ## to 255 and everything else set to 0.          ##
+   ###################################################
+   def cluster_band(self, band, apply_max_accumulate = False):
       image_array = []
       if(apply_max_accumulate):
          if(self.iteration == 0):
@@ -61,36 +346,121 @@ class KMeansConverter:
          band = np.copy(max_accum[1])
 
 
-      blurred_image = gaussian_filter(band, sigma=5)
+      with span("blur", engine=self.blur):
+         blurred_image = blur_band(band, sigma=5, engine=self.blur, num_threads=self.num_threads)
       
+      if self.engine == "histogram":
+         with span("kmeans", engine=self.engine):
+            center, assign, hist = self.histogram_centers(blurred_image)
+         # the brightest cluster that holds pixels, picked from the float
+         # centers since a uint16 center above 255 would wrap in uint8
+         occupied = np.bincount(assign, weights=hist, minlength=len(center)) > 0
+         fire = np.argmax(np.where(occupied, center, -np.inf))
+         lookup = np.where(assign == fire, 255, 0).astype(np.uint8)
+         return lookup[blurred_image]
+
       float_image = np.float32(blurred_image)
       num_data = float_image.shape[0]*float_image.shape[1]
       float_image = float_image.reshape(num_data, 1)
- 
-      # Criteria determines when K-Means will stop
-      criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 5, 0.0001)
-      ret,label,center = cv.kmeans(float_image, 5, None, criteria, 5, cv.KMEANS_RANDOM_CENTERS)
+      with span("kmeans", engine=self.engine):
+         label, center = self.opencv_centers(float_image)
 
       center = np.uint8(center)
       res = center[label.flatten()]
       k_applied_image = res.reshape((band.shape))
-      un = np.unique(k_applied_image)
 
       k_applied_image[k_applied_image == np.max(k_applied_image)] = 255
 
       k_applied_image[k_applied_image < np.max(k_applied_image)] = 0
 
-      meta['dtype'] = 'uint8'
-      if(save):
-         if not os.path.exists(save_directory):
-            os.makedirs(save_directory)
-         name = self.get_file_name(image_path)
-         if not os.path.exists(save_directory + "/" + name):
-            new_raster = rst.open(save_directory + '/' + name, 'w', **meta)
-            new_raster.write(k_applied_image, 1)
-            new_raster.close()
       return k_applied_image
 
+   ###################################################
+   ##       Function: opencv_centers                ##
+   ## Runs cv.kmeans on an N x 1 float32 image and  ##
+   ## returns its labels and centers. In sequence   ##
+   ## mode the labels start from the previous       ##
+   ## frame's centers, if seed_drift finds they     ##
+   ## still fit this frame, and the single attempt  ##
+   ## runs until it converges rather than for the   ##
+   ## 5 iterations of a restart.                    ##
+   ###################################################
+   def opencv_centers(self, float_image):
+      import cv2 as cv
+      # Criteria determines when K-Means will stop
+      criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 5, 0.0001)
+      if self.sequence and self.previous_centers is not None:
+         seed = self.previous_centers
+         label = np.searchsorted((seed[1:] + seed[:-1]) / 2, float_image).astype(np.int32)
+         if self.seed_drift(label.ravel(), float_image.ravel()) <= self.drift_threshold:
+            warm_criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 100, 0.0001)
+            ret,label,center = cv.kmeans(float_image, 5, label, warm_criteria, 1, cv.KMEANS_USE_INITIAL_LABELS)
+            self.previous_centers = np.sort(center.ravel())
+            return label, center
+         self.restarts += 1
+      ret,label,center = cv.kmeans(float_image, 5, None, criteria, 5, cv.KMEANS_RANDOM_CENTERS)
+      self.previous_centers = np.sort(center.ravel())
+      return label, center
+
+   ###################################################
+   ##       Function: histogram_centers             ##
+   ## Runs histogram_kmeans on an integer image. In ##
+   ## sequence mode it starts from the previous     ##
+   ## frame's centers, and a restart reuses the     ##
+   ## histogram. Returns the centers, assignments   ##
+   ## and histogram.                                ##
+   ###################################################
+   def histogram_centers(self, image):
+      hist = None
+      if self.sequence and self.previous_centers is not None:
+         center, assign, hist = histogram_kmeans(image, 5, center=self.previous_centers)
+         if self.accept_centers(center):
+            return center, assign, hist
+      center, assign, hist = histogram_kmeans(image, 5, hist=hist)
+      self.previous_centers = np.sort(center.ravel())
+      return center, assign, hist
+
+   ###################################################
+   ##       Function: seed_drift                    ##
+   ## How far the previous frame's centers are from ##
+   ## this frame's data before any iteration: the   ##
+   ## largest move of a center to the mean of the   ##
+   ## pixels labeled with it. A center left with no ##
+   ## pixels counts as infinitely far.              ##
+   ###################################################
+   def seed_drift(self, label, values):
+      k = len(self.previous_centers)
+      counts = np.bincount(label, minlength=k)
+      if np.any(counts == 0):
+         return np.inf
+      means = np.bincount(label, weights=values, minlength=k) / counts
+      return float(np.max(np.abs(means - self.previous_centers)))
+
+   ###################################################
+   ##       Function: accept_centers                ##
+   ## Keeps converged warm started centers (of the  ##
+   ## histogram engine) as the seed for the next    ##
+   ## frame if no center drifted more than          ##
+   ## drift_threshold from the previous frame.      ##
+   ## Otherwise counts a restart and returns False. ##
+   ###################################################
+   def accept_centers(self, center):
+      center = np.sort(np.ravel(center))
+      drift = np.max(np.abs(center - self.previous_centers))
+      if drift > self.drift_threshold:
+         self.restarts += 1
+         return False
+      self.previous_centers = center
+      return True
+
+   ###################################################
+   ##       Function: reset_sequence                ##
+   ## Forgets the previous frame's centers, e.g.    ##
+   ## before starting a new flight.                 ##
+   ###################################################
+   def reset_sequence(self):
+      self.previous_centers = None
+      self.restarts = 0
 
 
 def main():
@@ -122,12 +492,26 @@ def main():
          print("Applying KMeans...")
          for image_path in km.image_locations(path):
             km.apply_KMeans(image_path, save_directory, max_accumulate, save)
+         km.save_manifest()
       elif(user_input == '2'):
          print("To compress images you can use command line arguments, or if you do not insert anything\n")
          print("then you can run this program and enter input.\n")
          print("K Means Converter expects a directory of 1 band geotiffs.")
-         print("To apply kmeans to images please enter: kmeans [directory to apply] [save directory] [use max accumulate y or n] [save y or n]")
-   elif sys.argv[1].lower() == "kmeans" and len(sys.argv) == 6:
+         print("To apply kmeans to images please enter: kmeans [directory to apply] [save directory] [use max accumulate y or n] [save y or n] [engine (optional)] [blur (optional)] [output profile (optional)] [blur threads (optional)]")
+         print("The engine can be opencv (default) or histogram, which is exact and deterministic for 8 bit images.")
+         print("The blur can be scipy (default), opencv, box or decimated.")
+         print("The output profile can be fast, balanced (default) or archival.")
+         print("Blur threads blurs each image in that many strips of rows at once (default 1).")
+         print("To compare the blur engines against scipy's gaussian_filter please enter: blurcheck [image path] [engine (optional)] [blur threads (optional)]")
+   elif sys.argv[1].lower() == "kmeans" and len(sys.argv) in (6, 7, 8, 9, 10):
+      if len(sys.argv) >= 7:
+         km.engine = sys.argv[6]
+      if len(sys.argv) >= 8:
+         km.blur = sys.argv[7]
+      if len(sys.argv) >= 9:
+         km.output = sys.argv[8]
+      if len(sys.argv) == 10:
+         km.num_threads = int(sys.argv[9])
       max_accum = False
       save = False
       if sys.argv[4] == 'y':
@@ -136,18 +520,26 @@ def main():
          save = True
       for image_path in km.image_locations(path=sys.argv[2]):
          if save == True:
-            name = km.get_file_name(image_path)
-            new_path = sys.argv[3] + name
-            if not os.path.exists(new_path):
-               print(image_path)
-               km.apply_KMeans(image_path, sys.argv[3], sys.argv[4], sys.argv[5])
+            print(image_path)
          else:
             print("Not Saving")
-            km.apply_KMeans(image_path, sys.argv[3], sys.argv[4], sys.argv[5])
-   elif sys.argv[1].lower() == "kmeans" and len(sys.argv) != 4:
-      print("To apply kmeans to images please enter: kmeans image_directory_to_apply save_directory use_max_accumulate(t/n) save(y/n)")
+         km.apply_KMeans(image_path, sys.argv[3], max_accum, save)
+      km.save_manifest()
+   elif sys.argv[1].lower() == "blurcheck" and len(sys.argv) in (3, 4, 5):
+      import rasterio as rst
+      band = rst.open(sys.argv[2]).read(1)
+      engines = ["opencv", "box", "decimated"]
+      if len(sys.argv) >= 4:
+         engines = [sys.argv[3]]
+      num_threads = 1
+      if len(sys.argv) == 5:
+         num_threads = int(sys.argv[4])
+      for engine in engines:
+         print(engine, blur_accuracy(band, 5, engine, num_threads))
+   elif sys.argv[1].lower() == "kmeans" and len(sys.argv) not in (6, 7, 8, 9, 10):
+      print("To apply kmeans to images please enter: kmeans image_directory_to_apply save_directory use_max_accumulate(t/n) save(y/n) [opencv/histogram] [scipy/opencv/box/decimated] [fast/balanced/archival] [blur_threads]")
    else:
-      print("To apply kmeans to images please enter: kmeans image_directory_to_apply save_directory use_max_accumulate(t/n) save(y/n)")
+      print("To apply kmeans to images please enter: kmeans image_directory_to_apply save_directory use_max_accumulate(t/n) save(y/n) [opencv/histogram] [scipy/opencv/box/decimated] [fast/balanced/archival] [blur_threads]")
 
 
 if __name__ == "__main__":
@@ -1,13 +1,17 @@
-from CompressImage import CompressImage
+from CompressImage import CompressImage, compress_array_worker
 from KMeansConverter import KMeansConverter
 from ConnectedComp import ConnectedComp
 from Contour2Shp import Contour2Shp
-import matplotlib.pyplot as plt
 import os
 import sys
 from pathlib import Path
 import shutil
 import timeit
+from concurrent.futures import ProcessPoolExecutor
+from WorkerPool import bounded_map
+from OutputProfile import PROFILES, DEFAULT_PROFILE, write_raster
+import Instrumentation
+from Instrumentation import span, record, file_size
 
 '''----------------------------------------
 |   Created by Kathryn Reese               |
@@ -23,13 +27,27 @@ class Program:
       print("Connected Components is then applied to the kmeans images, and then connected components is saved as 3 npy files.")
       print("Contour2Shp then takes the connected component files and applies opencv's contouring method to these files, and then saves them as shape files.")
       print("\nYou can do each individual step, but ensure that you do them in the order described above.")
-      print("\nTo use this program enter \"python Main.py save/nosave directory_to_apply save_directory\"")
+      print("\nTo use this program enter \"python Main.py save/nosave directory_to_apply save_directory number_components [number_workers] [stream] [histogram] [warmstart] [gpkg/fgb] [mp4/nopreview] [trace] [fast/balanced/archival] [threads] [chunk=N] [blur=scipy/opencv/box/decimated] [blurthreads=N]\"")
       print("\tEnter save if you wish to save each type of geotiff/npy along the way.")
       print("\tEnter nosave if you wish to delete each type of geotiff/npy along the way.")
+      print("\tOptionally add the number of worker processes to use when compressing images and contouring (default 1).")
+      print("\tAdd stream at the end to pass each frame from compression to k-means to connected components in memory.")
+      print("\tIn stream mode compressed and k-means images are only written if save is given.")
+      print("\tAdd histogram at the end to use the exact histogram k-means engine instead of OpenCV's.")
+      print("\tAdd gpkg or fgb at the end to save every frame's contours in one GeoPackage or FlatGeobuf file instead of one shape file per frame.")
+      print("\tAdd warmstart at the end to start k-means on each frame from the previous frame's centers.")
+      print("\tAdd mp4 at the end to save the contour preview as a video instead of contour.npy, or nopreview to skip it.")
+      print("\tAdd fast, balanced (default) or archival at the end to pick how compressed and k-means images are written:")
+      print("\t\tfast is tiled and uncompressed, balanced is tiled with ZSTD (or LZW) compression, archival is a Cloud Optimized GeoTIFF with overviews.")
+      print("\tAdd threads at the end to let GDAL compress each image on every CPU. With several workers this can oversubscribe the machine.")
+      print("\tAdd blur=opencv, blur=box or blur=decimated at the end to blur before k-means with a faster engine than scipy's gaussian_filter (the default).")
+      print("\tAdd blurthreads=N at the end to blur each image in N strips of rows at once.")
+      print("\tAdd chunk=N at the end to label connected components N frames at a time, so memory does not grow with the number of frames.")
+      print("\tAdd trace at the end to time every stage and frame into save_directory/trace.jsonl and trace.json (Chrome trace format).")
 
-   def runPrograms(self, apply_directory, save_directory="Shape Files", num_components = 1, save=False):
+   def runPrograms(self, apply_directory, save_directory="Shape Files", num_components = 1, save=False, num_workers=1, band_num=4, kmeans_engine="opencv", warm_start=False, blur="scipy", blur_threads=1, chunk_size=None, output_format="shp", preview="npy", output=DEFAULT_PROFILE, write_threads=None):
       ci = CompressImage()
-      km = KMeansConverter()
+      km = KMeansConverter(kmeans_engine, warm_start, blur=blur, num_threads=blur_threads, output=output, write_threads=write_threads)
       cc = ConnectedComp()
       cs = Contour2Shp()
 
@@ -38,18 +56,20 @@ class Program:
 
       print("Step: Compressing Image")
       tic = timeit.default_timer()
-      longitude, latitude, width, height = ci.get_width_height(apply_directory)
-      for image_path in ci.image_locations(apply_directory):
-         ci.compress_image(image_path, save_directory + "/CompressedImages", longitude, latitude, width, height)
+      ci.get_roi_width_height(apply_directory, band_num, save_directory + "/extent_index.json")
+      ci.compress_images(ci.image_locations(apply_directory), save_directory + "/CompressedImages", num_workers, band_num, output, write_threads)
       toc = timeit.default_timer()
       print("Time to compress: {}" .format(str(toc-tic)))
+      record("stage", toc - tic, stage="compress")
 
       print("Step: Applying K-Means")
       tic = timeit.default_timer()
       for image_path in km.image_locations(save_directory + "/CompressedImages"):
          km.apply_KMeans(image_path, save_directory + "/KMeans")
+      km.save_manifest()
       toc = timeit.default_timer()
       print("Time applying K-Means: {}" .format(str(toc-tic)))
+      record("stage", toc - tic, stage="kmeans")
 
       if not save:
          print("Deleting Compressed Images...")
@@ -60,8 +80,13 @@ class Program:
 
       print("Step: Applying Connected Components")
       tic = timeit.default_timer()
-      cc.apply_connected_comp(save_directory + "/KMeans", save_directory + "/Connected Components/cc6_" + num_components, num_components)
+      if chunk_size is None:
+         cc.apply_connected_comp(save_directory + "/KMeans", save_directory + "/Connected Components/cc6_" + num_components, num_components)
+      else:
+         cc.apply_connected_comp(save_directory + "/KMeans", save_directory + "/Connected Components/cc6_" + num_components, num_components, None, chunk_size)
       toc = timeit.default_timer()
+      print("Time applying connected components: {}" .format(str(toc-tic)))
+      record("stage", toc - tic, stage="connected_components")
 
       if not save:
          print("Deleting K-Means...")
@@ -72,9 +97,10 @@ class Program:
 
       print("Step: Applying Contouring and Saving to shp")
       tic = timeit.default_timer()
-      cs.convert_npy_2_shp(save_directory + "/Connected Components", save_directory + "/Shape Files")
+      cs.convert_npy_2_shp(save_directory + "/Connected Components", save_directory + "/Shape Files", output_format=output_format, num_workers=num_workers, preview=preview)
       toc = timeit.default_timer()
       print("Time applying contouring and saving to shp: {}" .format(str(toc-tic)))
+      record("stage", toc - tic, stage="contours")
 
       if not save:
          print("Deleting Connected Components...")
@@ -86,20 +112,153 @@ class Program:
       print("Process Complete")
       print("You can view a shape file by using the commands \"python Contour2Shp.py view image_path\"")   
 
+   ###################################################
+   ##       Function: runStreaming                  ##
+   ## Same as runPrograms, but each frame flows     ##
+   ## from compression to k-means to connected      ##
+   ## components in memory. Compression runs in a   ##
+   ## process pool while k-means runs on the frames ##
+   ## already compressed, so the stages overlap.    ##
+   ## Compressed and k-means images are only        ##
+   ## written if save is True.                      ##
+   ###################################################
+   def runStreaming(self, apply_directory, save_directory="Shape Files", num_components = 1, save=False, num_workers=1, band_num=4, kmeans_engine="opencv", warm_start=False, blur="scipy", blur_threads=1, chunk_size=None, output_format="shp", preview="npy", output=DEFAULT_PROFILE, write_threads=None):
+      ci = CompressImage()
+      km = KMeansConverter(kmeans_engine, warm_start, blur=blur, num_threads=blur_threads, output=output, write_threads=write_threads)
+      cc = ConnectedComp()
+      cs = Contour2Shp()
+
+      if not os.path.exists(save_directory):
+         os.makedirs(save_directory)
+
+      print("Step: Compressing Image, Applying K-Means and Connected Components")
+      tic = timeit.default_timer()
+      ci.get_roi_width_height(apply_directory, band_num, save_directory + "/extent_index.json")
+      frames = self.stream_frames(ci, km, ci.image_locations(apply_directory), save_directory, save, num_workers, band_num, output, write_threads)
+      if chunk_size is None:
+         cc.connect_frames(frames, save_directory + "/Connected Components/cc6_" + num_components, num_components)
+      else:
+         cc.connect_frames_chunked(frames, save_directory + "/Connected Components/cc6_" + num_components, num_components, None, chunk_size)
+      toc = timeit.default_timer()
+      print("Time to compress, apply K-Means and connected components: {}" .format(str(toc-tic)))
+      record("stage", toc - tic, stage="compress, kmeans and connected_components")
+
+      print("Step: Applying Contouring and Saving to shp")
+      tic = timeit.default_timer()
+      cs.convert_npy_2_shp(save_directory + "/Connected Components", save_directory + "/Shape Files", output_format=output_format, num_workers=num_workers, preview=preview)
+      toc = timeit.default_timer()
+      print("Time applying contouring and saving to shp: {}" .format(str(toc-tic)))
+      record("stage", toc - tic, stage="contours")
+
+      if not save:
+         print("Deleting Connected Components...")
+         shutil.rmtree(save_directory + "/Connected Components")
+
+      print("Process Complete")
+      print("You can view a shape file by using the commands \"python Contour2Shp.py view image_path\"")
+
+   ###################################################
+   ##       Function: stream_frames                 ##
+   ## Yields (name, k-means image, transform) for   ##
+   ## each image in order. At most two frames per   ##
+   ## worker are in flight, so memory stays bounded ##
+   ## however long the flight is. Saved images are  ##
+   ## written with the output profile.              ##
+   ###################################################
+   def stream_frames(self, ci, km, image_paths, save_directory, save, num_workers, band_num, output=DEFAULT_PROFILE, write_threads=None):
+      compressed_directory = save_directory + "/CompressedImages"
+      kmeans_directory = save_directory + "/KMeans"
+      if save:
+         for directory in (compressed_directory, kmeans_directory):
+            if not os.path.exists(directory):
+               os.makedirs(directory)
+
+      grid = ci.target_grid()
+      tasks = []
+      for image_path in image_paths:
+         save_path = None
+         if save:
+            save_path = compressed_directory + "/" + ci.get_file_name(image_path)
+         tasks.append((image_path, save_path, grid, band_num, output, write_threads))
+
+      with ProcessPoolExecutor(max_workers=num_workers) as executor:
+         for image_path, band, profile, error in bounded_map(executor, compress_array_worker, tasks, 2 * num_workers):
+            name = ci.get_file_name(image_path)
+            if error is not None:
+               print("Could not compress the file: ", image_path)
+               print(error)
+               continue
+            with span("cluster", frame=name):
+               k_applied_image = km.cluster_band(band)
+            if save:
+               with span("write", frame=name, output=output) as fields:
+                  write_raster(kmeans_directory + "/" + name, k_applied_image, profile, output, write_threads, categorical=True)
+                  fields['bytes_written'] = file_size(kmeans_directory + "/" + name)
+            yield name, k_applied_image, profile['transform']
+
 def main():
-   plt.rcParams['animation.ffmpeg_path'] = '/usr/bin/ffmpeg' # I need this for some reason?? Take out if it causes issues.
    prog = Program()
+   flag_names = ('stream', 'histogram', 'warmstart', 'gpkg', 'fgb', 'mp4', 'nopreview', 'trace', 'threads') + PROFILES
+   option_names = ('chunk', 'blur', 'blurthreads')
+   flags = [arg.lower() for arg in sys.argv[1:] if arg.lower() in flag_names]
+   options = {}
+   for arg in sys.argv[1:]:
+      name, equals, value = arg.partition('=')
+      if equals and name.lower() in option_names:
+         options[name.lower()] = value
+   args = [arg for arg in sys.argv if arg.lower() not in flag_names and not ('=' in arg and arg.partition('=')[0].lower() in option_names)]
+   stream = 'stream' in flags
+   warm_start = 'warmstart' in flags
+   kmeans_engine = "opencv"
+   if 'histogram' in flags:
+      kmeans_engine = "histogram"
+   output_format = "shp"
+   for output_format_flag in ('gpkg', 'fgb'):
+      if output_format_flag in flags:
+         output_format = output_format_flag
+   preview = "npy"
+   if 'mp4' in flags:
+      preview = "mp4"
+   if 'nopreview' in flags:
+      preview = None
+   output = DEFAULT_PROFILE
+   for output_flag in PROFILES:
+      if output_flag in flags:
+         output = output_flag
+   write_threads = None
+   if 'threads' in flags:
+      write_threads = "ALL_CPUS"
+   chunk_size = None
+   if 'chunk' in options:
+      chunk_size = int(options['chunk'])
+   blur = options.get('blur', "scipy").lower()
+   blur_threads = int(options.get('blurthreads', 1))
    if len(sys.argv) == 1:
       print("Enter \"python Main.py help\" to learn how to use this program.")
    elif sys.argv[1] == 'help':
       prog.help()
-   elif len(sys.argv) == 5 and sys.argv[1].lower() == 'save':
-      prog.runPrograms(sys.argv[2], sys.argv[3], sys.argv[4], True)
-   elif len(sys.argv) == 5 and sys.argv[1].lower() == 'nosave':
-      prog.runPrograms(sys.argv[2], sys.argv[3], sys.argv[4], False)
+   elif len(args) in (5, 6) and args[1].lower() in ('save', 'nosave'):
+      num_workers = 1
+      if len(args) == 6:
+         num_workers = int(args[5])
+      trace_directory = args[3] + "/trace"
+      if 'trace' in flags:
+         if os.path.exists(trace_directory):
+            shutil.rmtree(trace_directory)
+         Instrumentation.enable(trace_directory)
+      if stream:
+         prog.runStreaming(args[2], args[3], args[4], args[1].lower() == 'save', num_workers, kmeans_engine=kmeans_engine, warm_start=warm_start, blur=blur, blur_threads=blur_threads, chunk_size=chunk_size, output_format=output_format, preview=preview, output=output, write_threads=write_threads)
+      else:
+         prog.runPrograms(args[2], args[3], args[4], args[1].lower() == 'save', num_workers, kmeans_engine=kmeans_engine, warm_start=warm_start, blur=blur, blur_threads=blur_threads, chunk_size=chunk_size, output_format=output_format, preview=preview, output=output, write_threads=write_threads)
+      if 'trace' in flags:
+         Instrumentation.disable()
+         Instrumentation.print_summary(trace_directory)
+         Instrumentation.export_jsonl(trace_directory, args[3] + "/trace.jsonl")
+         Instrumentation.export_chrome_trace(trace_directory, args[3] + "/trace.json")
+         print("Saved the trace to " + args[3] + "/trace.jsonl and " + args[3] + "/trace.json (open in chrome://tracing or Perfetto)")
    else:
       print("Enter \"python Main.py help\" to learn how to use this program.")
-      print("\nTo use this program enter \"python Main.py save/nosave directory_to_apply save_directory number_components\"")  
+      print("\nTo use this program enter \"python Main.py save/nosave directory_to_apply save_directory number_components [number_workers] [stream] [histogram] [warmstart] [gpkg/fgb] [mp4/nopreview] [trace] [fast/balanced/archival] [threads] [chunk=N] [blur=scipy/opencv/box/decimated] [blurthreads=N]\"")  
 
 
 if __name__ == "__main__":
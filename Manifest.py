@@ -0,0 +1,151 @@
+import os
+import json
+import hashlib
+
+'''----------------------------------------
+|   Class: Manifest                        |
+|   Records which outputs of a stage are   |
+|   up to date, so a rerun only redoes the |
+|   frames whose input, parameters or      |
+|   output changed.                        |
+|------------------------------------------|
+'''
+
+
+###################################################
+##       Function: load_json                     ##
+## Reads a JSON file written by save_json. A     ##
+## missing file is empty, and an unreadable one  ##
+## is empty after printing warning and the path. ##
+###################################################
+def load_json(path, warning):
+   if not os.path.exists(path):
+      return {}
+   try:
+      with open(path, "r") as json_file:
+         return json.load(json_file)
+   except ValueError:
+      print(warning, path)
+      return {}
+
+
+###################################################
+##       Function: save_json                     ##
+## Writes data to a temporary file and moves it  ##
+## into place, so an interrupted run never       ##
+## leaves a half written file.                   ##
+###################################################
+def save_json(data, path):
+   directory = os.path.dirname(path)
+   if directory != "" and not os.path.exists(directory):
+      os.makedirs(directory)
+   temp_path = path + ".tmp"
+   with open(temp_path, "w") as json_file:
+      json.dump(data, json_file, indent=1)
+   os.replace(temp_path, path)
+
+
+class Manifest:
+   ###################################################
+   ##       Function: __init__                      ##
+   ## Loads directory/manifest.json. Entries are    ##
+   ## kept per stage and keyed by the absolute      ##
+   ## input path. params are the stage parameters;  ##
+   ## an entry made with other parameters is out of ##
+   ## date.                                         ##
+   ###################################################
+   def __init__(self, directory, stage, params=None, save_every=25):
+      self.path = directory + "/manifest.json"
+      self.stage = stage
+      # round trip through json so tuples and lists compare equal to what was saved
+      self.params = json.loads(json.dumps(params if params is not None else {}))
+      self.save_every = save_every
+      self.unsaved = 0
+      self.stages = self.load()
+      self.entries = self.stages.setdefault(stage, {})
+
+   ###################################################
+   ##       Function: load                          ##
+   ## Reads the manifest. A missing or unreadable   ##
+   ## manifest is treated as empty, which redoes    ##
+   ## every frame.                                  ##
+   ###################################################
+   def load(self):
+      return load_json(self.path, "Could not read the manifest, redoing all frames: ")
+
+   ###################################################
+   ##       Function: save                          ##
+   ## Writes the manifest with save_json.           ##
+   ###################################################
+   def save(self):
+      save_json(self.stages, self.path)
+      self.unsaved = 0
+
+   ###################################################
+   ##       Function: signature                     ##
+   ## Identifies the current contents of a file by  ##
+   ## its size and modification time.               ##
+   ## A directory is identified by the signatures   ##
+   ## of the files in it. Returns None if the path  ##
+   ## does not exist.                               ##
+   ###################################################
+   def signature(self, path):
+      if os.path.isdir(path):
+         digest = hashlib.sha1()
+         for name in sorted(os.listdir(path)):
+            if name.startswith("manifest.json"):
+               continue
+            digest.update(name.encode())
+            digest.update(json.dumps(self.signature(os.path.join(path, name))).encode())
+         return {'listing': digest.hexdigest()}
+      if not os.path.exists(path):
+         return None
+      stat = os.stat(path)
+      return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+   ###################################################
+   ##       Function: is_current                    ##
+   ## True if output_paths (one path or a list)     ##
+   ## were recorded for input_path with the same    ##
+   ## parameters, and neither the input nor any     ##
+   ## output has changed since.                     ##
+   ###################################################
+   def is_current(self, input_path, output_paths):
+      if isinstance(output_paths, str):
+         output_paths = [output_paths]
+      entry = self.entries.get(os.path.abspath(input_path))
+      if entry is None or entry['params'] != self.params:
+         return False
+      if entry['input'] != self.signature(input_path):
+         return False
+      outputs = {os.path.abspath(path): self.output_signature(path) for path in output_paths}
+      return None not in outputs.values() and entry['outputs'] == outputs
+
+   ###################################################
+   ##       Function: output_signature              ##
+   ## Size and modification time of an output.      ##
+   ###################################################
+   def output_signature(self, path):
+      if not os.path.exists(path):
+         return None
+      stat = os.stat(path)
+      return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+   ###################################################
+   ##       Function: record                        ##
+   ## Records that output_paths were made from      ##
+   ## input_path. Call it only after the outputs    ##
+   ## are completely written. The manifest is saved ##
+   ## every save_every records.                     ##
+   ###################################################
+   def record(self, input_path, output_paths):
+      if isinstance(output_paths, str):
+         output_paths = [output_paths]
+      self.entries[os.path.abspath(input_path)] = {
+         'input': self.signature(input_path),
+         'params': self.params,
+         'outputs': {os.path.abspath(path): self.output_signature(path) for path in output_paths}
+      }
+      self.unsaved += 1
+      if self.unsaved >= self.save_every:
+         self.save()
@@ -0,0 +1,172 @@
+import numpy as np
+import sys
+import warnings
+from functools import lru_cache
+
+'''----------------------------------------
+|   Class: OutputProfile                   |
+|   Named GeoTIFF profiles used by every   |
+|   stage that writes a raster, so tiling  |
+|   and compression are set in one place.  |
+|------------------------------------------|
+'''
+
+# fast     - tiled, uncompressed: quickest to write, largest on disk
+# balanced - tiled, fast ZSTD (LZW if GDAL has no ZSTD) with a predictor
+# archival - Cloud Optimized GeoTIFF with overviews and slower, tighter ZSTD
+PROFILES = ('fast', 'balanced', 'archival')
+DEFAULT_PROFILE = 'balanced'
+BLOCK_SIZE = 256
+
+# Keys of a rasterio profile that describe the data rather than how it is stored
+DATA_KEYS = ('driver', 'width', 'height', 'count', 'dtype', 'crs', 'transform', 'nodata')
+
+
+###################################################
+##       Function: zstd_available                ##
+## True if GDAL was built with ZSTD, found by    ##
+## writing a tiny in-memory GeoTIFF once.        ##
+###################################################
+@lru_cache(maxsize=None)
+def zstd_available():
+   from rasterio.io import MemoryFile
+   from rasterio.errors import NotGeoreferencedWarning
+   try:
+      with warnings.catch_warnings(), MemoryFile() as memfile:
+         warnings.simplefilter("ignore", NotGeoreferencedWarning)
+         with memfile.open(driver='GTiff', width=16, height=16, count=1, dtype='uint8', compress='zstd') as dataset:
+            dataset.write(np.zeros((16, 16), dtype=np.uint8), 1)
+         with memfile.open() as dataset:
+            return dataset.compression is not None and dataset.compression.value == 'ZSTD'
+   except Exception:
+      return False
+
+
+###################################################
+##       Function: check_profile                 ##
+## Raises a ValueError for an unknown profile.   ##
+###################################################
+def check_profile(output):
+   if output not in PROFILES:
+      raise ValueError("Unknown output profile: " + str(output) + " (use " + "/".join(PROFILES) + ")")
+
+
+###################################################
+##       Function: creation_options              ##
+## GeoTIFF creation options of a profile for     ##
+## data of dtype. Integer data uses horizontal   ##
+## differencing as its predictor and floating    ##
+## point data the floating point predictor.      ##
+## categorical images (k-means classes) get no   ##
+## predictor, since differencing a 0/255 mask    ##
+## only makes it compress worse. num_threads (a  ##
+## number or "ALL_CPUS") lets GDAL compress      ##
+## blocks on several threads.                    ##
+###################################################
+def creation_options(output, dtype, num_threads=None, categorical=False):
+   check_profile(output)
+   options = {'tiled': True, 'blockxsize': BLOCK_SIZE, 'blockysize': BLOCK_SIZE}
+   if output != 'fast':
+      if not categorical:
+         options['predictor'] = 2 if np.issubdtype(np.dtype(dtype), np.integer) else 3
+      if zstd_available():
+         options['compress'] = 'zstd'
+         # levels above 9 were over ten times slower for a few percent
+         options['zstd_level'] = 1 if output == 'balanced' else 9
+      else:
+         options['compress'] = 'lzw'
+   if num_threads is not None:
+      options['num_threads'] = str(num_threads)
+   return options
+
+
+###################################################
+##       Function: raster_profile                ##
+## Copies the data keys of a rasterio profile    ##
+## (size, dtype, crs, transform, nodata) and     ##
+## adds the creation options of output, dropping ##
+## whatever tiling or compression the source     ##
+## profile had.                                  ##
+###################################################
+def raster_profile(profile, output=DEFAULT_PROFILE, num_threads=None, categorical=False):
+   new_profile = {key: profile[key] for key in DATA_KEYS if key in profile}
+   new_profile['driver'] = 'GTiff'
+   new_profile.update(creation_options(output, new_profile['dtype'], num_threads, categorical))
+   return new_profile
+
+
+###################################################
+##       Function: cog_options                   ##
+## Options of GDAL's COG driver for the archival ##
+## profile. Overviews are made down to a single  ##
+## block, averaged or, for categorical images,   ##
+## nearest so no new classes appear.             ##
+###################################################
+def cog_options(dtype, num_threads=None, categorical=False):
+   options = creation_options('archival', dtype, num_threads, categorical)
+   cog = {
+      'blocksize': BLOCK_SIZE,
+      'compress': options['compress'],
+      'overviews': 'AUTO',
+      'resampling': 'NEAREST' if categorical else 'AVERAGE'
+   }
+   if 'predictor' in options:
+      cog['predictor'] = 'STANDARD' if options['predictor'] == 2 else 'FLOATING_POINT'
+   if 'zstd_level' in options:
+      cog['level'] = options['zstd_level']
+   if 'num_threads' in options:
+      cog['num_threads'] = options['num_threads']
+   return cog
+
+
+###################################################
+##       Function: copy_raster                   ##
+## Copies an open dataset (e.g. a WarpedVRT) to  ##
+## save_path with the output profile.            ##
+###################################################
+def copy_raster(src, save_path, output=DEFAULT_PROFILE, num_threads=None, categorical=False):
+   from rasterio import shutil as rio_shutil
+   check_profile(output)
+   dtype = src.dtypes[0]
+   if output == 'archival':
+      rio_shutil.copy(src, save_path, driver='COG', **cog_options(dtype, num_threads, categorical))
+   else:
+      rio_shutil.copy(src, save_path, driver='GTiff', **creation_options(output, dtype, num_threads, categorical))
+
+
+###################################################
+##       Function: write_raster                  ##
+## Writes a single band to save_path with the    ##
+## output profile, taking its size, crs and      ##
+## transform from profile. The COG driver can    ##
+## only copy a finished dataset, so for archival ##
+## the band is first written to memory. Set      ##
+## categorical for class images (see             ##
+## creation_options).                            ##
+###################################################
+def write_raster(save_path, band, profile, output=DEFAULT_PROFILE, num_threads=None, categorical=False):
+   import rasterio as rst
+   from rasterio.io import MemoryFile
+   new_profile = dict(profile, count=1, dtype=band.dtype.name)
+   new_profile = raster_profile(new_profile, output, num_threads, categorical)
+   if output == 'archival':
+      with MemoryFile() as memfile:
+         with memfile.open(**raster_profile(new_profile, 'fast')) as dataset:
+            dataset.write(band, 1)
+         with memfile.open() as dataset:
+            copy_raster(dataset, save_path, output, num_threads, categorical)
+   else:
+      with rst.open(save_path, 'w', **new_profile) as raster:
+         raster.write(band, 1)
+
+
+def main():
+   if len(sys.argv) == 2 and sys.argv[1] in PROFILES:
+      print(creation_options(sys.argv[1], 'uint8'))
+   else:
+      print("Output profiles: " + ", ".join(PROFILES) + " (default " + DEFAULT_PROFILE + ")")
+      print("To see the GeoTIFF creation options of a profile please enter: profile_name")
+      print("To compare how fast each profile writes please run: python Benchmark.py profiles work_directory results.json")
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,26 @@
+from collections import deque
+
+'''----------------------------------------
+|   Class: WorkerPool                      |
+|   Helpers for running per-frame work     |
+|   in a pool of workers without holding   |
+|   every result in memory.                |
+|------------------------------------------|
+'''
+
+###################################################
+##       Function: bounded_map                   ##
+## Like executor.map, but only max_inflight      ##
+## tasks are submitted at any time. Results are  ##
+## yielded in task order, so a slow consumer     ##
+## holds back the workers instead of letting     ##
+## finished frames pile up in memory.            ##
+###################################################
+def bounded_map(executor, function, tasks, max_inflight):
+   inflight = deque()
+   for task in tasks:
+      if len(inflight) >= max_inflight:
+         yield inflight.popleft().result()
+      inflight.append(executor.submit(function, task))
+   while inflight:
+      yield inflight.popleft().result()